@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+
+import trip_connections
+from instrumentation import recorder
+
+
+# Benchmarks the stages of trip_connections on synthetic GTFS feeds, run with
+# python benchmark.py [--trips 100000 ...] and see --help for the scale options.
+# The first agency is a corridor (rail) agency whose routes stop at every station, the
+# others are local agencies with part of their stops around the stations. The timings
+# and peak memory of each stage are written to a JSON file to track regressions.
+
+BENCHMARK_DATE = '2020-03-10'
+# rough centre and extent of the GTHA
+CENTRE_LAT = 43.65
+CENTRE_LON = -79.6
+EXTENT_DEGREES = 0.5
+# stations are GO-like stops named after the station, the corridor agency's routes run
+# through all of them and local stops are placed within this many metres of them
+STATION_STOP_RADIUS = 300
+METRES_PER_DEGREE = 111000
+
+
+def write_gtfs_zip(path, tables):
+    """Writes the dict of file name -> dataframe as a GTFS zip"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as gtfs_zip:
+        for name, df in tables.items():
+            gtfs_zip.writestr(name, df.to_csv(index=False))
+
+
+def clocktimes(seconds):
+    seconds = pd.Series(seconds)
+    return (
+        (seconds // 3600).map('{:02}'.format) + ':'
+        + ((seconds % 3600) // 60).map('{:02}'.format) + ':'
+        + (seconds % 60).map('{:02}'.format)
+    )
+
+
+def generate_agency(
+    rng,
+    agency_id,
+    station_lats,
+    station_lons,
+    station_names,
+    stop_count,
+    trip_count,
+    stops_per_trip,
+    is_corridor,
+):
+    """Returns the GTFS tables of one synthetic agency"""
+    station_count = len(station_names)
+    if is_corridor:
+        # one stop per station, named after it so that it becomes a station stop
+        stop_lats = np.asarray(station_lats)
+        stop_lons = np.asarray(station_lons)
+        stop_names = list(station_names)
+        route_count = max(1, station_count // stops_per_trip)
+    else:
+        # half of the stops are around the stations, the rest anywhere
+        near_count = min(stop_count // 2, station_count * 20) if station_count else 0
+        near_stations = rng.integers(0, max(station_count, 1), near_count)
+        offset = STATION_STOP_RADIUS / METRES_PER_DEGREE
+        stop_lats = np.concatenate([
+            np.asarray(station_lats)[near_stations] + rng.uniform(-offset, offset, near_count),
+            CENTRE_LAT + rng.uniform(-EXTENT_DEGREES, EXTENT_DEGREES, stop_count - near_count),
+        ])
+        stop_lons = np.concatenate([
+            np.asarray(station_lons)[near_stations] + rng.uniform(-offset, offset, near_count),
+            CENTRE_LON + rng.uniform(-EXTENT_DEGREES, EXTENT_DEGREES, stop_count - near_count),
+        ])
+        stop_names = ['{} Stop {}'.format(agency_id, stop) for stop in range(stop_count)]
+        route_count = max(1, stop_count // stops_per_trip)
+    stop_count = len(stop_names)
+    stop_ids = np.array(['{}-{}'.format(agency_id, stop) for stop in range(stop_count)])
+    stops_df = pd.DataFrame({
+        'stop_id': stop_ids,
+        'stop_name': stop_names,
+        'stop_lat': stop_lats,
+        'stop_lon': stop_lons,
+    })
+
+    # each route has a fixed pattern of stops, the stations in order for corridor routes
+    route_stops_per_trip = min(stops_per_trip, stop_count)
+    if is_corridor:
+        route_patterns = np.array_split(np.arange(stop_count), route_count)
+        route_patterns = [pattern for pattern in route_patterns if len(pattern) > 0]
+        route_count = len(route_patterns)
+    else:
+        route_patterns = [
+            rng.choice(stop_count, route_stops_per_trip, replace=False)
+            for _ in range(route_count)
+        ]
+    route_ids = np.array(['{}-R{}'.format(agency_id, route) for route in range(route_count)])
+    routes_df = pd.DataFrame({
+        'route_id': route_ids,
+        'agency_id': agency_id,
+        'route_short_name': [str(route) for route in range(route_count)],
+        'route_long_name': ['Route {}'.format(route) for route in range(route_count)],
+        'route_type': 2 if is_corridor else 3,
+    })
+
+    trip_routes = rng.integers(0, route_count, trip_count)
+    # half of the trips run the pattern backwards, towards Union Station
+    is_reversed = rng.random(trip_count) < 0.5
+    trips_df = pd.DataFrame({
+        'route_id': route_ids[trip_routes],
+        'service_id': 'WEEKDAY',
+        'trip_id': ['{}-T{}'.format(agency_id, trip) for trip in range(trip_count)],
+        'trip_headsign': np.where(is_reversed, 'Union Station', 'Outbound'),
+        'trip_short_name': '',
+    })
+
+    trip_lengths = np.array([len(route_patterns[route]) for route in trip_routes])
+    trip_stops = np.concatenate([
+        route_patterns[route][::-1] if reversed_trip else route_patterns[route]
+        for route, reversed_trip in zip(trip_routes, is_reversed)
+    ])
+    trip_ids = np.repeat(trips_df['trip_id'].to_numpy(), trip_lengths)
+    trip_starts = np.repeat(rng.integers(5 * 3600, 24 * 3600, trip_count), trip_lengths)
+    trip_firsts = np.repeat(np.cumsum(trip_lengths) - trip_lengths, trip_lengths)
+    stop_sequences = np.arange(len(trip_stops)) - trip_firsts
+    # one to three minutes between stops
+    travel_times = rng.integers(60, 180, len(trip_stops))
+    travel_times[stop_sequences == 0] = 0
+    trip_travel_times = np.cumsum(travel_times)
+    departure_times = trip_starts + trip_travel_times - trip_travel_times[trip_firsts]
+    stop_times_df = pd.DataFrame({
+        'trip_id': trip_ids,
+        'arrival_time': clocktimes(departure_times),
+        'departure_time': clocktimes(departure_times),
+        'stop_id': stop_ids[trip_stops],
+        'stop_sequence': stop_sequences + 1,
+    })
+
+    return {
+        'agency.txt': pd.DataFrame({
+            'agency_id': [agency_id],
+            'agency_name': [agency_id],
+            'agency_url': ['http://example.com'],
+            'agency_timezone': ['America/Toronto'],
+        }),
+        'calendar.txt': pd.DataFrame({
+            'service_id': ['WEEKDAY'],
+            **{
+                day: [1]
+                for day in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+            },
+            'start_date': ['20200101'],
+            'end_date': ['20201231'],
+        }),
+        'stops.txt': stops_df,
+        'routes.txt': routes_df,
+        'trips.txt': trips_df,
+        'stop_times.txt': stop_times_df,
+    }
+
+
+def generate_network(
+    gtfs_directory,
+    agencies,
+    stops,
+    trips,
+    stops_per_trip,
+    stations,
+    seed=0,
+):
+    """Writes the synthetic GTFS zips of a corridor agency and agencies - 1 local agencies
+    to gtfs_directory, with stops, trips and stops_per_trip for each local agency.
+    Returns the agency names (inpaths) and the stations map (station -> corridor routes)"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(gtfs_directory, exist_ok=True)
+    station_names = ['Station {}'.format(station) for station in range(stations)]
+    station_lats = CENTRE_LAT + rng.uniform(-EXTENT_DEGREES, EXTENT_DEGREES, stations)
+    station_lons = CENTRE_LON + rng.uniform(-EXTENT_DEGREES, EXTENT_DEGREES, stations)
+    inpaths = []
+    corridor_routes = {}
+    for agency in range(agencies):
+        is_corridor = agency == 0
+        agency_id = 'CORRIDOR' if is_corridor else 'LOCAL{}'.format(agency)
+        tables = generate_agency(
+            rng,
+            agency_id,
+            station_lats,
+            station_lons,
+            station_names,
+            stops,
+            # the corridor runs a tenth as many trips
+            max(1, trips // 10) if is_corridor else trips,
+            stops_per_trip,
+            is_corridor,
+        )
+        if is_corridor:
+            stop_routes = tables['stop_times.txt'].merge(
+                tables['trips.txt'],
+                on='trip_id',
+            ).merge(tables['routes.txt'], on='route_id')
+            for station_name, stop_id in zip(tables['stops.txt']['stop_name'], tables['stops.txt']['stop_id']):
+                corridor_routes[station_name] = sorted(set(
+                    stop_routes.loc[stop_routes['stop_id'] == stop_id, 'route_short_name']
+                ))
+        write_gtfs_zip(os.path.join(gtfs_directory, agency_id + '.zip'), tables)
+        inpaths.append(agency_id)
+    return inpaths, {station_name: corridor_routes.get(station_name, []) for station_name in station_names}
+
+
+@contextlib.contextmanager
+def timed(results, stage):
+    """Records the wall time of the stage, the process peak memory after it, and how much
+    the stage raised that peak (as the run report does)"""
+    # the stages print their progress (dates selected, feeds loaded...), which would drown
+    # out the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        with recorder.stage('benchmark_' + stage) as record:
+            yield
+    results[stage] = {
+        'seconds': record['seconds'],
+        'peak_rss_mb': record['peak_rss_mb'],
+        # the peak is that of the whole process so far, a stage using less memory than
+        # an earlier one grows it by 0
+        'peak_rss_growth_mb': record['peak_rss_growth_mb'],
+    }
+    print(stage, '{:.3f}s, peak RSS +{:.0f} MB'.format(
+        results[stage]['seconds'],
+        results[stage]['peak_rss_growth_mb'],
+    ))
+
+
+def run_benchmark(gtfs_directory, inpaths, stations, config):
+    """Times each stage of trip_connections on the feeds, returns the results of each
+    stage along with the number of stop times and of connections"""
+    results = {}
+    trip_connections.inpaths = inpaths
+    trip_connections.gtfs_directory = gtfs_directory
+    _date = datetime.datetime.strptime(BENCHMARK_DATE, '%Y-%m-%d').date()
+    with timed(results, 'get_feed_df'):
+        trip_connections.get_feed_df(trip_connections.get_zip_paths()[-1], [_date], 'error')
+    with timed(results, 'initialize_feeds'):
+        network = trip_connections.Network.load(date_strs=[BENCHMARK_DATE], missing_service='error')
+        network.select_service_date(BENCHMARK_DATE)
+
+    station_connection_args = trip_connections.get_station_connection_args(config)
+    with timed(results, 'get_local_msp_connections'):
+        connections_df = pd.concat([trip_connections.empty_connections_df()] + [
+            network.connections(
+                station_name=station_name,
+                corridor_route_ids=corridor_route_ids,
+                location_overrides=[],
+                **station_connection_args,
+            )
+            for station_name, corridor_route_ids in stations.items()
+        ], ignore_index=True)
+    with timed(results, 'get_all_local_msp_connections'):
+        network.all_connections(
+            stations=stations,
+            location_overrides={},
+            **station_connection_args,
+        )
+
+    # classification alone, on the nearby trip stop times of every station
+    station_inputs = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        station_nearby_stops_dfs = {}
+        station_stops_by_name = {}
+        for station_name in stations:
+            station_stops = network.station_stops(station_name)
+            station_stops_by_name[station_name] = station_stops
+            station_nearby_stops_dfs[station_name] = network.nearby_stops(
+                station_name,
+                station_stops,
+                config['connection_max_distance'],
+            )
+        nearby_stop_times = network.all_nearby_trip_stop_times(station_nearby_stops_dfs)
+    with timed(results, 'get_stop_time_meeting_types'):
+        for station_name, corridor_route_ids in stations.items():
+            nearby_stop_times_df = nearby_stop_times[station_name]
+            trip_connections.get_stop_time_meeting_types(
+                nearby_stop_times_df.assign(is_corridor=trip_connections.get_corridor_stop_times(
+                    nearby_stop_times_df,
+                    station_stops_by_name[station_name],
+                    corridor_route_ids,
+                )),
+                config['min_inbound_minutes'],
+                config['max_inbound_minutes'],
+                config['min_outbound_minutes'],
+                config['max_outbound_minutes'],
+                config['hourly_summary'],
+                config.get('union_station_is_inbound', False),
+            )
+
+    with timed(results, 'output_workbook'):
+        trip_connections.output_workbook(
+            connections_df,
+            list(stations),
+            './output/transit_connections.xlsx',
+        )
+    return results, {
+        'stop_times': len(network.stop_times_df),
+        'connections': len(connections_df),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark trip_connections on synthetic GTFS')
+    parser.add_argument('--agencies', type=int, default=4, help='number of agencies, including the corridor agency')
+    parser.add_argument('--stops', type=int, default=5000, help='stops of each local agency')
+    parser.add_argument('--trips', type=int, default=20000, help='trips of each local agency')
+    parser.add_argument('--stops-per-trip', type=int, default=30)
+    parser.add_argument('--stations', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gtfs-directory', help='where to write the synthetic GTFS, a temporary directory by default')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    scale = {
+        'agencies': args.agencies,
+        'stops': args.stops,
+        'trips': args.trips,
+        'stops_per_trip': args.stops_per_trip,
+        'stations': args.stations,
+        'seed': args.seed,
+    }
+    config = trip_connections.read_config()
+    output_path = os.path.abspath(args.output)
+    with tempfile.TemporaryDirectory() as work_directory:
+        gtfs_directory = os.path.abspath(args.gtfs_directory or os.path.join(work_directory, 'gtfs'))
+        start = time.perf_counter()
+        inpaths, stations = generate_network(gtfs_directory, **scale)
+        print('Generated GTFS in {:.1f}s'.format(time.perf_counter() - start))
+        # the stages write their output relative to the working directory
+        os.makedirs(os.path.join(work_directory, 'output', 'dev'))
+        os.chdir(work_directory)
+        stages, rows = run_benchmark(gtfs_directory, inpaths, stations, config)
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'scale': scale,
+            'rows': rows,
+            'stages': stages,
+        }, output_file, indent=2)
+    print('Wrote', output_path)
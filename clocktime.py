@@ -0,0 +1,39 @@
+import numpy as np
+
+
+# Conversions between GTFS clock times (hh:mm or hh:mm:ss, past 24:00 for trips running
+# after midnight) and seconds after midnight of the service date.
+
+# hh:mm of every minute of the first 48 hours, extended when formatting later times
+_minute_labels = np.array(
+    ['{:02}:{:02}'.format(minute // 60, minute % 60) for minute in range(48 * 60)],
+    dtype=object,
+)
+
+
+def clocktime_to_seconds(clocktime):
+    """Converts a hh:mm (or hh:mm:ss) time to seconds after midnight, rounding down to the
+    minute. Raises ValueError if it isn't a time"""
+    parts = clocktime.split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError('Invalid time {}, expected hh:mm'.format(clocktime))
+    return int(parts[0]) * 3600 + int(parts[1]) * 60
+
+
+def clocktimes_to_seconds(times):
+    """Converts a Series of hh:mm:ss strings to seconds after midnight (NaN if untimed)"""
+    parts = times.str.extract(r'(\d+):(\d+):(\d+)').astype(float)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def seconds_to_clocktimes(seconds):
+    """Returns the hh:mm of each time in seconds, as an object array"""
+    global _minute_labels
+    # TTC GTFS has seconds for some reason - round down to the minute
+    minutes = np.asarray(seconds, dtype=np.int64) // 60
+    if len(minutes) > 0 and minutes.max() >= len(_minute_labels):
+        _minute_labels = np.array(
+            ['{:02}:{:02}'.format(minute // 60, minute % 60) for minute in range(minutes.max() + 1)],
+            dtype=object,
+        )
+    return _minute_labels[minutes]
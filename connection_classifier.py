@@ -0,0 +1,134 @@
+import numpy as np
+
+
+# Classifies local transit trips against the corridor arrivals at a station using
+# sorted arrays of corridor arrival minutes, so that every transfer window query is a
+# pair of binary searches instead of a loop over every corridor arrival. The windows and
+# peak split time may differ for each local trip (see transfer_rules.py), all trips are
+# still joined to the corridor arrivals in one pass of binary searches.
+
+NOON = 60*60*12
+PEAK_DIRECTION = 'Union Station'
+
+
+def to_minutes(times):
+    """Rounds times in seconds down to the minute, TTC GTFS has seconds for some reason"""
+    return np.floor_divide(np.asarray(times, dtype=float), 60)
+
+
+def sorted_corridor_minutes(corridor_arrival_times):
+    return np.sort(to_minutes(corridor_arrival_times))
+
+
+def window_connections(
+    minutes,
+    sorted_minutes,
+    is_outbound,
+    min_inbound_minutes,
+    max_inbound_minutes,
+    min_outbound_minutes,
+    max_outbound_minutes,
+):
+    """Returns the number of inbound (corridor arrives min-max minutes after the local
+    trip) or outbound (corridor arrives min-max minutes before) connections of each local
+    trip minute, and the wait in minutes of the closest one (NaN without connections).
+    The windows are either one value or an array of a value for each local trip."""
+    if is_outbound:
+        lower = minutes - max_outbound_minutes
+        upper = minutes - min_outbound_minutes
+    else:
+        lower = minutes + min_inbound_minutes
+        upper = minutes + max_inbound_minutes
+    first = np.searchsorted(sorted_minutes, lower, side='left')
+    end = np.searchsorted(sorted_minutes, upper, side='right')
+    counts = end - first
+    waits = np.full(len(minutes), np.nan)
+    has_connection = counts > 0
+    if is_outbound:
+        # the last corridor arrival in the window is the closest before the local trip
+        waits[has_connection] = minutes[has_connection] - sorted_minutes[end[has_connection] - 1]
+    else:
+        waits[has_connection] = sorted_minutes[first[has_connection]] - minutes[has_connection]
+    return counts, waits
+
+
+def has_connections(minutes, sorted_minutes, is_outbound, *windows):
+    """Whether each local trip minute has an inbound or outbound connection"""
+    counts, _ = window_connections(minutes, sorted_minutes, is_outbound, *windows)
+    return counts > 0
+
+
+def combine_connection_types(inbound, outbound):
+    return np.select(
+        [inbound & outbound, inbound, outbound],
+        ['Both', 'Inbound', 'Outbound'],
+        'None',
+    ).astype(object)
+
+
+def classify_connections(
+    departure_times,
+    skip_inbound,
+    skip_outbound,
+    corridor_arrival_times,
+    corridor_directions,
+    min_inbound_minutes,
+    max_inbound_minutes,
+    min_outbound_minutes,
+    max_outbound_minutes,
+    peak_split_times=NOON,
+):
+    """Returns (connection_types, peak_connection_types, connections) of each local trip,
+    both types of Inbound, Outbound, Both, or None. The peak connection type only counts
+    corridor trips heading to Union Station before the peak split time (noon by default)
+    or from Union Station afterwards. connections holds the inbound_connections and
+    outbound_connections counts, and the min_inbound_wait and min_outbound_wait minutes.
+    The windows and peak split times are one value or an array of one for each trip."""
+    windows = (
+        np.asarray(min_inbound_minutes, dtype=float),
+        np.asarray(max_inbound_minutes, dtype=float),
+        np.asarray(min_outbound_minutes, dtype=float),
+        np.asarray(max_outbound_minutes, dtype=float),
+    )
+    departure_times = np.asarray(departure_times, dtype=float)
+    minutes = to_minutes(departure_times)
+    skip_inbound = np.asarray(skip_inbound, dtype=bool)
+    skip_outbound = np.asarray(skip_outbound, dtype=bool)
+    corridor_arrival_times = np.asarray(corridor_arrival_times, dtype=float)
+    to_union = np.array(
+        [PEAK_DIRECTION in str(direction) for direction in corridor_directions],
+        dtype=bool,
+    )
+
+    all_minutes = sorted_corridor_minutes(corridor_arrival_times)
+    inbound_counts, inbound_waits = window_connections(minutes, all_minutes, False, *windows)
+    outbound_counts, outbound_waits = window_connections(minutes, all_minutes, True, *windows)
+    inbound_counts[skip_inbound] = 0
+    inbound_waits[skip_inbound] = np.nan
+    outbound_counts[skip_outbound] = 0
+    outbound_waits[skip_outbound] = np.nan
+    connection_types = combine_connection_types(inbound_counts > 0, outbound_counts > 0)
+
+    # peak connections only compare to corridor trips towards Union Station before the
+    # peak split, and to corridor trips away from Union Station from then onwards
+    union_minutes = sorted_corridor_minutes(corridor_arrival_times[to_union])
+    other_minutes = sorted_corridor_minutes(corridor_arrival_times[~to_union])
+    is_morning = departure_times < peak_split_times
+    peak_inbound = ~skip_inbound & np.where(
+        is_morning,
+        has_connections(minutes, union_minutes, False, *windows),
+        has_connections(minutes, other_minutes, False, *windows),
+    )
+    peak_outbound = ~skip_outbound & np.where(
+        is_morning,
+        has_connections(minutes, union_minutes, True, *windows),
+        has_connections(minutes, other_minutes, True, *windows),
+    )
+    peak_connection_types = combine_connection_types(peak_inbound, peak_outbound)
+    connections = {
+        'inbound_connections': inbound_counts,
+        'outbound_connections': outbound_counts,
+        'min_inbound_wait': inbound_waits,
+        'min_outbound_wait': outbound_waits,
+    }
+    return connection_types, peak_connection_types, connections
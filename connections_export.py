@@ -0,0 +1,111 @@
+import os
+import shutil
+from urllib.parse import quote
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrumentation import recorder
+
+
+# Columnar export of the connections tables, and optionally of the classified nearby stop
+# times, for dashboards to load without parsing the workbook. Each is a Parquet dataset
+# partitioned by date and station (hive style, date=.../station=.../part-0.parquet), with
+# the fixed schemas below whatever columns the feeds have, e.g.
+#   pd.read_parquet('output/parquet/connections', filters=[('station', '=', 'Bramalea GO')])
+# Each date's partitions are replaced whenever the date is exported again.
+
+EXPORT_PATH = './output/parquet'
+
+# the date and station columns are the partition keys, stored in the directory names
+CONNECTIONS_SCHEMA = pa.schema([
+    ('arrival_time', pa.string()),
+    ('departure_time', pa.string()),
+    ('connection_type', pa.string()),
+    ('peak_connection_type', pa.string()),
+    ('agency', pa.string()),
+    ('route', pa.string()),
+    ('direction', pa.string()),
+    ('stop', pa.string()),
+    ('inbound_connections', pa.int32()),
+    ('outbound_connections', pa.int32()),
+    ('min_inbound_wait', pa.float64()),
+    ('min_outbound_wait', pa.float64()),
+    ('is_peak_connection', pa.bool_()),
+])
+
+# times are seconds after midnight
+STOP_TIMES_SCHEMA = pa.schema([
+    ('agency', pa.string()),
+    ('route_id', pa.string()),
+    ('route_short_name', pa.string()),
+    ('trip_id', pa.string()),
+    ('trip_headsign', pa.string()),
+    ('stop_id', pa.string()),
+    ('stop_name', pa.string()),
+    ('stop_sequence', pa.int32()),
+    ('trip_stop_count', pa.int32()),
+    ('arrival_time', pa.int32()),
+    ('departure_time', pa.int32()),
+    ('connection_distance', pa.float64()),
+    ('is_corridor', pa.bool_()),
+    ('connection_type', pa.string()),
+    ('peak_connection_type', pa.string()),
+    ('inbound_connections', pa.int32()),
+    ('outbound_connections', pa.int32()),
+    ('min_inbound_wait', pa.float64()),
+    ('min_outbound_wait', pa.float64()),
+])
+
+
+def get_date_path(dataset, date_str, export_path=EXPORT_PATH):
+    """Returns the directory of the date's partitions of the dataset (connections or
+    stop_times)"""
+    return os.path.join(export_path, dataset, 'date={}'.format(quote(date_str, safe='')))
+
+
+def clear_date(dataset, date_str, export_path=EXPORT_PATH):
+    """Removes the date's partitions of the dataset, so no station is left from a
+    previous export"""
+    shutil.rmtree(get_date_path(dataset, date_str, export_path), ignore_errors=True)
+
+
+def to_table(df, schema):
+    """Returns the columns of the schema from df as an Arrow table, null where df doesn't
+    have the column. ids are written as strings whatever type the feed gave them."""
+    columns = []
+    for field in schema:
+        if field.name not in df.columns:
+            columns.append(pa.nulls(len(df), field.type))
+            continue
+        values = df[field.name]
+        if pa.types.is_string(field.type):
+            values = values.astype(object).where(values.notna(), None)
+            values = values.map(lambda value: value if value is None else str(value))
+        columns.append(pa.array(values.to_numpy(), type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_station(df, schema, date_path, station_name):
+    station_path = os.path.join(date_path, 'station={}'.format(quote(station_name, safe='')))
+    os.makedirs(station_path, exist_ok=True)
+    pq.write_table(to_table(df, schema), os.path.join(station_path, 'part-0.parquet'))
+
+
+def export_connections(connections_df, date_str, export_path=EXPORT_PATH):
+    """Writes the connections table of every station on the date"""
+    with recorder.stage('export_connections', rows_in=len(connections_df)):
+        clear_date('connections', date_str, export_path)
+        date_path = get_date_path('connections', date_str, export_path)
+        for station_name, station_connections_df in connections_df.groupby('station', sort=False):
+            write_station(station_connections_df, CONNECTIONS_SCHEMA, date_path, station_name)
+    # the schema of the dataset, for readers that don't open any partition
+    os.makedirs(os.path.join(export_path, 'connections'), exist_ok=True)
+    pq.write_metadata(CONNECTIONS_SCHEMA, os.path.join(export_path, 'connections', '_common_metadata'))
+
+
+def export_stop_times(nearby_stop_times_df, date_path, station_name):
+    """Writes the classified nearby stop times of the station, date_path is the
+    get_date_path of the stop_times dataset"""
+    write_station(nearby_stop_times_df, STOP_TIMES_SCHEMA, date_path, station_name)
+    stop_times_path = os.path.dirname(os.path.normpath(date_path))
+    pq.write_metadata(STOP_TIMES_SCHEMA, os.path.join(stop_times_path, '_common_metadata'))
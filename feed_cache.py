@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+# Cache keys of the dataframes built from the GTFS zips, and the on-disk cache of each
+# agency's normalized dataframes built by load_agency_frames and of the pipeline stages,
+# stored as Parquet (requires pyarrow) in a directory per cache key. The combined network
+# built by Network.load is stored as a memory-mapped feed store instead (see
+# feed_store.py). The key covers the contents of every GTFS zip, the selected service
+# date, any loading options, and CACHE_VERSION.
+
+# bump whenever Network.load or load_agency_frames change the dataframes that they produce
+CACHE_VERSION = 8
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def zip_sha256(path):
+    """Returns the sha256 of the GTFS zip, taken from the manifest.json of its snapshot
+    (see gtfs_fetch.py) when the zip's size and modification time match the manifest"""
+    manifest_path = os.path.join(os.path.dirname(path), 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            feeds = json.load(manifest_file)['feeds']
+        entry = feeds.get(os.path.splitext(os.path.basename(path))[0])
+        stat = os.stat(path)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return entry['sha256']
+    return file_sha256(path)
+
+
+def feed_cache_key(zip_paths, date_str, options=None):
+    """options holds any other settings that change the loaded feeds"""
+    key = {
+        'version': CACHE_VERSION,
+        'date': date_str or 'busiest',
+        'options': options,
+        'feeds': [[os.path.basename(path), zip_sha256(path)] for path in zip_paths],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_frames(cache_path, key):
+    """Returns dict of name -> dataframe stored under the key, or None if not cached"""
+    frames_path = os.path.join(cache_path, key)
+    meta_path = os.path.join(frames_path, 'frames.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    frames = {}
+    for name, frame_meta in meta.items():
+        df = pd.read_parquet(os.path.join(frames_path, name + '.parquet'))
+        # Parquet returns missing strings as None, restore the NaN the feeds were loaded with
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].notna(), np.nan)
+        if frame_meta['index'] is not None:
+            df.set_index(frame_meta['index'], inplace=True)
+        frames[name] = df
+    return frames
+
+
+def save_frames(cache_path, key, frames):
+    """Writes the dict of name -> dataframe under the key, replacing it atomically"""
+    frames_path = os.path.join(cache_path, key)
+    tmp_path = frames_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    meta = {}
+    for name, df in frames.items():
+        has_index = any(index_name is not None for index_name in df.index.names)
+        meta[name] = {
+            'index': list(df.index.names) if has_index else None,
+        }
+        (df.reset_index() if has_index else df).to_parquet(
+            os.path.join(tmp_path, name + '.parquet'),
+            index=False,
+        )
+    with open(os.path.join(tmp_path, 'frames.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    shutil.rmtree(frames_path, ignore_errors=True)
+    os.replace(tmp_path, frames_path)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+
+# Interning of the agency-qualified stop, trip and route ids of the combined feeds into
+# dense int32 keys. The key of a stop, trip or route is its row position in the combined
+# stops, trips or routes dataframe, so those dataframes double as the reverse lookup
+# tables and joining on a key is a positional take instead of a string hash join.
+
+
+def encode_keys(table_df, df, columns):
+    """Returns the int32 key (row position in table_df) of the ids in the given columns of
+    each row of df, -1 where the ids are not in table_df"""
+    table_index = pd.MultiIndex.from_frame(table_df[columns])
+    return table_index.get_indexer(pd.MultiIndex.from_frame(df[columns])).astype(np.int32)
+
+
+def keep_keyed_rows(table_df, keep, keys):
+    """Drops the rows of table_df that aren't kept, returning the table along with the
+    given keys into it remapped to the new row positions (-1 for dropped rows, and for
+    keys that are already -1)"""
+    keep = np.asarray(keep, dtype=bool)
+    # the extra last entry maps the -1 keys to -1 instead of wrapping around
+    new_keys = np.append(np.where(keep, np.cumsum(keep) - 1, -1), -1).astype(np.int32)
+    return table_df[keep].reset_index(drop=True), new_keys[np.asarray(keys)]
+
+
+def join_by_key(df, table_df, key_column):
+    """Adds the columns of table_df that df doesn't already have, taking the row of
+    table_df at each key in df[key_column]"""
+    rows = table_df.take(df[key_column].to_numpy())
+    return df.assign(**{
+        column: rows[column].to_numpy()
+        for column in table_df.columns
+        if column not in df.columns
+    })
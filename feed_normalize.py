@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+
+# Normalization of an agency's stop times, run once when the agency's feed is loaded:
+# untimed stops are interpolated between the timed stops of their trip (by
+# shape_dist_traveled where the feed has it, by stop order otherwise), times become int32
+# seconds after midnight, and the columns that the analysis doesn't use are dropped.
+# Anomalies found along the way are counted for the agency's report.
+
+# stop_times columns kept, shape_dist_traveled is only used for interpolation
+STOP_TIME_COLUMNS = ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time']
+
+ANOMALIES = [
+    # untimed stops given interpolated times
+    'interpolated_stop_times',
+    # untimed stops before the first or after the last timed stop of their trip, given the
+    # time of the nearest timed stop
+    'extrapolated_stop_times',
+    # trips without any timed stop, dropped
+    'untimed_trips',
+    'single_stop_trips',
+    'duplicate_stop_sequences',
+    'departures_before_arrival',
+    # stop times departing before the previous stop of their trip
+    'decreasing_times',
+]
+
+
+def interpolate_times(times, trip_codes, positions):
+    """Given the times (NaN if untimed) of stop times sorted by trip and stop_sequence,
+    returns the times with the untimed stops interpolated linearly in their position
+    between the timed stops around them, or given the nearest time at the trip's ends.
+    positions may be NaN where unknown, the stop order is used instead."""
+    is_timed = times.notna()
+    by_trip = times.groupby(trip_codes, sort=False)
+    previous_time = by_trip.ffill()
+    next_time = by_trip.bfill()
+    stop_positions = pd.Series(
+        pd.Series(trip_codes).groupby(trip_codes, sort=False).cumcount().to_numpy(),
+        index=times.index,
+        dtype=float,
+    )
+
+    def get_fractions(positions):
+        timed_positions = positions.where(is_timed).groupby(trip_codes, sort=False)
+        previous_position = timed_positions.ffill()
+        span = timed_positions.bfill() - previous_position
+        return ((positions - previous_position) / span.where(span > 0)).clip(0, 1)
+
+    fractions = get_fractions(stop_positions)
+    if positions is not None:
+        fractions = get_fractions(positions).fillna(fractions)
+    interpolated = previous_time + (next_time - previous_time) * fractions.fillna(0)
+    return interpolated.fillna(previous_time).fillna(next_time)
+
+
+def normalize_stop_times(stop_times_df):
+    """Returns the agency's stop times with STOP_TIME_COLUMNS, interpolated int32 times
+    and int32 stop_sequence, in the order given, along with the count of each anomaly"""
+    anomalies = dict.fromkeys(ANOMALIES, 0)
+    if stop_times_df.empty:
+        return stop_times_df[STOP_TIME_COLUMNS], anomalies
+    # a stop time with only one of its times has the same arrival and departure
+    arrival_times = stop_times_df['arrival_time'].fillna(stop_times_df['departure_time'])
+    departure_times = stop_times_df['departure_time'].fillna(stop_times_df['arrival_time'])
+
+    trip_codes, _ = pd.factorize(stop_times_df['trip_id'])
+    stop_sequences = stop_times_df['stop_sequence'].to_numpy()
+    order = np.lexsort((stop_sequences, trip_codes))
+    trip_codes = trip_codes[order]
+    positions = None
+    if 'shape_dist_traveled' in stop_times_df.columns:
+        positions = stop_times_df['shape_dist_traveled'].iloc[order].reset_index(drop=True)
+    sorted_departure_times = departure_times.iloc[order].reset_index(drop=True)
+    is_untimed = sorted_departure_times.isna().to_numpy()
+
+    interpolated = interpolate_times(sorted_departure_times, trip_codes, positions)
+    trip_timed_counts = np.bincount(trip_codes, weights=~is_untimed)
+    trip_sizes = np.bincount(trip_codes)
+    is_untimed_trip = trip_timed_counts[trip_codes] == 0
+    # interpolated stops have timed stops on both sides within the trip
+    timed_before = pd.Series(~is_untimed).groupby(trip_codes, sort=False).cummax().to_numpy()
+    timed_after = pd.Series(~is_untimed[::-1]).groupby(trip_codes[::-1], sort=False).cummax().to_numpy()[::-1]
+    is_interpolated = is_untimed & timed_before & timed_after
+    anomalies['interpolated_stop_times'] = int(is_interpolated.sum())
+    anomalies['extrapolated_stop_times'] = int((is_untimed & ~is_interpolated & ~is_untimed_trip).sum())
+    anomalies['untimed_trips'] = int((trip_timed_counts == 0).sum())
+    anomalies['single_stop_trips'] = int((trip_sizes == 1).sum())
+    is_same_trip = trip_codes[1:] == trip_codes[:-1]
+    anomalies['duplicate_stop_sequences'] = int((is_same_trip & (np.diff(stop_sequences[order]) == 0)).sum())
+    anomalies['departures_before_arrival'] = int((departure_times < arrival_times).sum())
+    anomalies['decreasing_times'] = int((is_same_trip & (np.diff(interpolated.to_numpy()) < 0)).sum())
+
+    # untimed stops take the same interpolated arrival and departure time
+    filled_departure_times = np.empty(len(order))
+    filled_departure_times[order] = interpolated.to_numpy()
+    is_kept = ~np.isnan(filled_departure_times)
+    is_stop_untimed = departure_times.isna().to_numpy()
+    filled_arrival_times = np.where(is_stop_untimed, filled_departure_times, arrival_times.to_numpy())
+    normalized_df = stop_times_df[STOP_TIME_COLUMNS].assign(
+        arrival_time=np.round(filled_arrival_times),
+        departure_time=np.round(filled_departure_times),
+    )[is_kept]
+    normalized_df = normalized_df.astype({
+        'arrival_time': np.int32,
+        'departure_time': np.int32,
+        'stop_sequence': np.int32,
+    })
+    return normalized_df, anomalies
+
+
+def get_anomalies_df(anomalies, agency):
+    """Returns a row of agency, anomaly and count for each anomaly found"""
+    return pd.DataFrame(
+        [(agency, anomaly, count) for anomaly, count in anomalies.items() if count > 0],
+        columns=['agency', 'anomaly', 'count'],
+    )
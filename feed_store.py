@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+from feed_cache import feed_cache_key
+
+
+# Binary store of the dataframes compiled from the GTFS zips, opened with memory mapping.
+# Every column is a fixed-width .npy file: numeric columns as they are, and text columns
+# as integer codes into a dictionary of the column's distinct strings (stored alongside as
+# a fixed-width unicode .npy). Opening a store maps the column files instead of reading
+# them, so startup only pages in the columns that a run touches, and processes opening the
+# same store share its pages in the OS page cache. The frames opened are read only.
+#
+# Frames are opened the first time that they're accessed, and their text columns are
+# decoded into object columns then, each row pointing at the one string of its value in
+# the dictionary: grouping and sorting on pandas categoricals falls back to slow paths,
+# which cost far more per station than the decoding does. Only the small stops, trips and
+# routes tables (and the service dates) have text columns, the stop times and trip stop
+# sequences are all numbers and stay mapped.
+#
+# Network.load compiles the network into a store in the cache_path under its feed cache
+# key (which covers the GTFS zips, the dates and CACHE_VERSION), and opens it from there
+# on the next runs. Run python feed_store.py to compile the network of the dates and
+# gtfs_directory in config.json ahead of time, e.g. after fetching a new snapshot:
+#   python gtfs_fetch.py && python feed_store.py
+
+# bump whenever the layout of the store changes
+STORE_VERSION = 1
+
+
+def get_store_path(cache_path, key):
+    return os.path.join(cache_path, 'store-' + key)
+
+
+def encode_text(values):
+    """Returns the integer codes of the values into a dictionary of their distinct
+    strings (-1 for missing values), along with the dictionary as a unicode array"""
+    categorical = pd.Categorical(values)
+    return categorical.codes, categorical.categories.to_numpy(dtype=str)
+
+
+def decode_text(codes, dictionary):
+    """Returns the object array of the dictionary's strings at the codes, NaN at -1"""
+    # the last entry is taken by the -1 codes of missing values
+    strings = np.append(dictionary.astype(object), np.nan)
+    return strings.take(np.where(codes < 0, len(dictionary), codes))
+
+
+def save_store(cache_path, key, frames):
+    """Writes the dict of name -> dataframe as a store under the key, replacing it atomically"""
+    store_path = get_store_path(cache_path, key)
+    tmp_path = store_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    meta = {'version': STORE_VERSION, 'frames': {}}
+    for name, df in frames.items():
+        has_index = any(index_name is not None for index_name in df.index.names)
+        if has_index:
+            df = df.reset_index()
+        columns = []
+        # files are named by column position as column names may not be valid file names
+        for position, column in enumerate(df.columns):
+            file_name = '{}.{}'.format(name, position)
+            values = df[column]
+            if values.dtype.kind in 'biuf':
+                np.save(os.path.join(tmp_path, file_name + '.npy'), values.to_numpy())
+                columns.append({'name': column, 'file': file_name, 'text': False})
+                continue
+            codes, dictionary = encode_text(values)
+            np.save(os.path.join(tmp_path, file_name + '.npy'), codes)
+            np.save(os.path.join(tmp_path, file_name + '.dictionary.npy'), dictionary)
+            columns.append({'name': column, 'file': file_name, 'text': True})
+        meta['frames'][name] = {
+            'columns': columns,
+            'length': len(df),
+            'index': list(df.columns[:len(frames[name].index.names)]) if has_index else None,
+        }
+    with open(os.path.join(tmp_path, 'store.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(tmp_path, store_path)
+
+
+class StoreFrames(Mapping):
+    """The frames of a store by name, each opened the first time that it is accessed"""
+
+    def __init__(self, store_path, meta):
+        self.store_path = store_path
+        self.meta = meta
+        self.frames = {}
+
+    def __getitem__(self, name):
+        if name not in self.frames:
+            self.frames[name] = self.open_frame(self.meta['frames'][name])
+        return self.frames[name]
+
+    def __iter__(self):
+        return iter(self.meta['frames'])
+
+    def __len__(self):
+        return len(self.meta['frames'])
+
+    def open_frame(self, frame_meta):
+        columns = {}
+        for column in frame_meta['columns']:
+            values = np.load(os.path.join(self.store_path, column['file'] + '.npy'), mmap_mode='r')
+            if column['text']:
+                values = decode_text(
+                    values,
+                    np.load(os.path.join(self.store_path, column['file'] + '.dictionary.npy')),
+                )
+            columns[column['name']] = values
+        # without copy=False the columns are consolidated into new 2D blocks
+        df = pd.DataFrame(columns, index=pd.RangeIndex(frame_meta['length']), copy=False)
+        if frame_meta['index'] is not None:
+            df.set_index(frame_meta['index'], inplace=True)
+        return df
+
+
+def load_store(cache_path, key):
+    """Returns the StoreFrames of the store under the key, with columns mapped from its
+    files, or None if there's no store"""
+    store_path = get_store_path(cache_path, key)
+    meta_path = os.path.join(store_path, 'store.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    if meta['version'] != STORE_VERSION:
+        return None
+    return StoreFrames(store_path, meta)
+
+
+def get_shapes_frames(zip_path):
+    """Returns the shapes, trips and routes of the busiest date of the feed, the shapes
+    sorted by shape_id and shape_pt_sequence"""
+    import partridge as ptg
+    _date, service_ids = ptg.read_busiest_date(zip_path)
+    feed = ptg.load_feed(zip_path, {'trips.txt': {'service_id': service_ids}})
+    return {
+        'shapes': feed.shapes.sort_values(['shape_id', 'shape_pt_sequence'], ignore_index=True),
+        'trips': feed.trips.reset_index(drop=True),
+        'routes': feed.routes.reset_index(drop=True),
+    }
+
+
+def load_shapes(zip_path, cache_path='cache'):
+    """Returns the get_shapes_frames of the feed from its store, compiling it if needed"""
+    key = feed_cache_key([zip_path], None, {'store': 'shapes'})
+    frames = load_store(cache_path, key)
+    if frames is None:
+        save_store(cache_path, key, get_shapes_frames(zip_path))
+        frames = load_store(cache_path, key)
+    return frames
+
+
+if __name__ == '__main__':
+    import argparse
+    import trip_connections
+    input_dict = trip_connections.read_config()
+    parser = argparse.ArgumentParser(description='Compiles the network of config.json into a feed store')
+    parser.add_argument(
+        '--directory',
+        default=input_dict.get('gtfs_directory'),
+        help='directory of the GTFS zips, e.g. a snapshot fetched by gtfs_fetch.py',
+    )
+    args = parser.parse_args()
+    trip_connections.Network.load(
+        date_strs=trip_connections.read_config_dates(input_dict),
+        cache_path=input_dict.get('cache_path') or 'cache',
+        workers=input_dict.get('feed_workers', 1),
+        missing_service=input_dict.get('missing_service', 'prompt'),
+        directory=args.directory,
+    )
@@ -1,12 +1,32 @@
-# Gets the current GTFS files and updates the GTFS directory.
-# MAKE SURE YOU MOVE THE GTFS FILES ALREADY IN THE GTFS DIRECTORY SOMEWHERE ELSE
-# (ie. rename the folder to something like gtfs_fall_2019)
+# Gets the current GTFS files into a new snapshot directory, run with python gtfs_fetch.py.
+#
+# The feeds are downloaded concurrently and streamed to disk. A feed is only downloaded
+# again when its server reports a change (ETag / Last-Modified), and an interrupted
+# download resumes where it stopped on the next run. Each run that changes a feed writes
+# a complete snapshot, gtfs_snapshots/{time}/, with a zip for every feed (unchanged feeds
+# are linked from the previous snapshot) and a manifest.json of their sources, sizes and
+# sha256 hashes. gtfs_snapshots/latest links to the newest snapshot, which is the default
+# "gtfs_directory" of config.json that the feeds are analyzed from, so running
+#   python gtfs_fetch.py && python trip_connections.py
+# analyzes the latest feeds. Older snapshots are never modified, set "gtfs_directory" to
+# one of them to analyze it again.
 
 
-import requests
+import argparse
+import datetime
+import hashlib
+import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
-gtfs_directory = 'gtfs'
+snapshots_directory = 'gtfs_snapshots'
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 1024 * 1024
+# seconds to connect, and between bytes received
+TIMEOUT = (10, 60)
 gtfs_config = [
   {
     'name': 'Barrie Transit',
@@ -64,14 +84,197 @@ gtfs_config = [
     'source': 'https://www.yrt.ca/google/google_transit.zip',
   },
 ]
-if not os.path.exists(gtfs_directory):
-    os.mkdir(gtfs_directory)
-
-for gtfs in gtfs_config:
-    if 'source' not in gtfs:
-        print('Warning:', gtfs['name'], 'does not have a GTFS source - it will be skipped. Open gtfs_fetch.py and add in the GTFS link under the "source" key as is done in the other agencies.')
-        continue
-    req = requests.get(gtfs['source'])
-    with open(gtfs_directory + '/' + gtfs['name'] + '.zip', 'wb') as gtfs_stream:
-        gtfs_stream.write(req.content)
-    print('Updated', gtfs['name'], 'in', gtfs_directory)
+
+
+def get_latest_snapshot(snapshots_directory):
+    """Returns the path of the newest snapshot, or None if there is none"""
+    latest_path = os.path.join(snapshots_directory, 'latest')
+    if not os.path.islink(latest_path):
+        return None
+    return os.path.join(snapshots_directory, os.readlink(latest_path))
+
+
+def read_manifest(snapshot_path):
+    """Returns the manifest of the snapshot, with no feeds if there is no snapshot"""
+    if snapshot_path is None:
+        return {'feeds': {}}
+    with open(os.path.join(snapshot_path, MANIFEST)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_conditional_headers(entry):
+    """Headers asking the server to only send the feed if it changed since the entry"""
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def download(session, source, part_path, headers, timeout=TIMEOUT):
+    """Streams the source to part_path, continuing a partial download left by an earlier
+    run when the source hasn't changed since. Returns the response, or None if the server
+    answered that the source is unchanged, along with the sha256 of the file"""
+    validator_path = part_path + '.validator'
+    headers = dict(headers)
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        with open(validator_path) as validator_file:
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(part_path))
+            # the server sends the whole source instead if it changed
+            headers['If-Range'] = validator_file.read()
+    sha = hashlib.sha256()
+    with session.get(source, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return None, None
+        response.raise_for_status()
+        mode = 'wb'
+        # a validator left for an earlier body doesn't hold for this one, unless replaced
+        if response.status_code != 206 and os.path.exists(validator_path):
+            os.remove(validator_path)
+        if response.status_code == 206:
+            mode = 'ab'
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(CHUNK_SIZE), b''):
+                    sha.update(chunk)
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if validator is not None:
+            with open(validator_path, 'w') as validator_file:
+                validator_file.write(validator)
+        with open(part_path, mode) as part_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha.update(chunk)
+                part_file.write(chunk)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+    return response, sha.hexdigest()
+
+
+def link_or_copy(path, new_path):
+    """Hard links the unchanged file into the new snapshot, copying it if the file system
+    has no hard links"""
+    try:
+        os.link(path, new_path)
+    except OSError:
+        shutil.copy2(path, new_path)
+
+
+def fetch_feed(gtfs, snapshot_path, partial_path, previous_snapshot_path, previous_entry, timeout=TIMEOUT):
+    """Gets the feed into the snapshot being written, linking it from the previous snapshot
+    if it didn't change. Returns the feed's manifest entry"""
+    file_name = gtfs['name'] + '.zip'
+    part_path = os.path.join(partial_path, file_name + '.part')
+    with requests.Session() as session:
+        response, sha256 = download(
+            session,
+            gtfs['source'],
+            part_path,
+            get_conditional_headers(previous_entry),
+            timeout,
+        )
+    # servers without conditional requests send the feed again, compare the hashes
+    if response is None or (previous_entry is not None and previous_entry['sha256'] == sha256):
+        if response is not None:
+            os.remove(part_path)
+        link_or_copy(os.path.join(previous_snapshot_path, file_name), os.path.join(snapshot_path, file_name))
+        print('Unchanged', gtfs['name'])
+        return dict(previous_entry, changed=False)
+    zip_path = os.path.join(snapshot_path, file_name)
+    os.replace(part_path, zip_path)
+    print('Updated', gtfs['name'])
+    return {
+        'file': file_name,
+        'source': gtfs['source'],
+        'sha256': sha256,
+        'size': os.path.getsize(zip_path),
+        'mtime_ns': os.stat(zip_path).st_mtime_ns,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'fetched_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'changed': True,
+    }
+
+
+def fetch_all(gtfs_config, snapshots_directory, workers=4, timeout=TIMEOUT):
+    """Fetches every feed of gtfs_config with a source, in parallel. Writes a new snapshot
+    and points latest to it unless no feed changed. Returns the latest snapshot's path.
+
+    A feed that fails to download keeps its version of the previous snapshot"""
+    previous_snapshot_path = get_latest_snapshot(snapshots_directory)
+    previous_feeds = read_manifest(previous_snapshot_path)['feeds']
+    created = datetime.datetime.now(datetime.timezone.utc)
+    snapshot_name = created.strftime('%Y%m%dT%H%M%SZ')
+    if os.path.exists(os.path.join(snapshots_directory, snapshot_name)):
+        # fetched twice within the second
+        snapshot_name = created.strftime('%Y%m%dT%H%M%S%fZ')
+    snapshot_path = os.path.join(snapshots_directory, snapshot_name)
+    # the snapshot is written under a temporary name so that it is only ever seen complete
+    tmp_path = snapshot_path + '.tmp'
+    partial_path = os.path.join(snapshots_directory, 'partial')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    os.makedirs(partial_path, exist_ok=True)
+
+    sources = []
+    for gtfs in gtfs_config:
+        if 'source' not in gtfs:
+            print('Warning:', gtfs['name'], 'does not have a GTFS source - it will be skipped. Open gtfs_fetch.py and add in the GTFS link under the "source" key as is done in the other agencies.')
+            continue
+        sources.append(gtfs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            gtfs['name']: executor.submit(
+                fetch_feed,
+                gtfs,
+                tmp_path,
+                partial_path,
+                previous_snapshot_path,
+                previous_feeds.get(gtfs['name']),
+                timeout,
+            )
+            for gtfs in sources
+        }
+    feeds = {}
+    for name, future in futures.items():
+        try:
+            feeds[name] = future.result()
+        except (requests.RequestException, OSError) as error:
+            print('Failed to fetch', name, ':', error)
+            if name in previous_feeds:
+                print('Keeping the previous', name)
+                link_or_copy(
+                    os.path.join(previous_snapshot_path, previous_feeds[name]['file']),
+                    os.path.join(tmp_path, previous_feeds[name]['file']),
+                )
+                feeds[name] = dict(previous_feeds[name], changed=False)
+
+    if set(feeds) == set(previous_feeds) and not any(entry['changed'] for entry in feeds.values()):
+        shutil.rmtree(tmp_path)
+        print('No feeds changed, the latest snapshot is still', previous_snapshot_path)
+        return previous_snapshot_path
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as manifest_file:
+        json.dump({
+            'snapshot': snapshot_name,
+            'created': created.isoformat(timespec='seconds'),
+            'previous': None if previous_snapshot_path is None else os.path.basename(previous_snapshot_path),
+            'feeds': feeds,
+        }, manifest_file, indent=2)
+    os.replace(tmp_path, snapshot_path)
+    # swap the latest link atomically
+    latest_tmp_path = os.path.join(snapshots_directory, 'latest.tmp')
+    if os.path.lexists(latest_tmp_path):
+        os.remove(latest_tmp_path)
+    os.symlink(snapshot_name, latest_tmp_path)
+    os.replace(latest_tmp_path, os.path.join(snapshots_directory, 'latest'))
+    print('Wrote snapshot', snapshot_path)
+    return snapshot_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the GTFS of every agency into a new snapshot')
+    parser.add_argument('--snapshots-directory', default=snapshots_directory)
+    parser.add_argument('--workers', type=int, default=4, help='number of feeds downloaded at once')
+    args = parser.parse_args()
+    fetch_all(gtfs_config, args.snapshots_directory, args.workers)
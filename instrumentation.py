@@ -0,0 +1,217 @@
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+# Records the wall time, rows in and out, and peak memory of each stage of a run (with
+# the agency or station it ran for), and can profile every run of one stage with cProfile
+# or a sampling profiler. The run report is written as JSON along with a text summary.
+#
+# Stages are recorded with the module's recorder:
+#   with recorder.stage('get_nearby_stops', station=station_name, rows_in=...) as record:
+#       ...
+#       record['rows_out'] = len(nearby_stops_df)
+
+PROFILERS = ['cprofile', 'sampling']
+# number of functions listed in the profile of the report
+PROFILE_TOP = 30
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class SamplingProfiler:
+    """Samples the stack of the thread that started it every interval seconds, counting
+    the samples in which each function is running (inclusive) or on top of the stack"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.inclusive = Counter()
+        self.leaf = Counter()
+        self.samples = 0
+        self.thread = None
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.leaf[get_frame_function(frame)] += 1
+            functions = set()
+            while frame is not None:
+                functions.add(get_frame_function(frame))
+                frame = frame.f_back
+            self.inclusive.update(functions)
+
+    def report(self):
+        return {
+            'samples': self.samples,
+            'interval': self.interval,
+            'inclusive': [
+                {'function': function, 'samples': samples}
+                for function, samples in self.inclusive.most_common(PROFILE_TOP)
+            ],
+            'leaf': [
+                {'function': function, 'samples': samples}
+                for function, samples in self.leaf.most_common(PROFILE_TOP)
+            ],
+        }
+
+
+def get_frame_function(frame):
+    code = frame.f_code
+    return '{}:{}({})'.format(code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class Recorder:
+
+    def __init__(self):
+        self.records = []
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now()
+        self.stack = []
+        self.profile_stage = None
+        self.profiler = None
+
+    def set_profiler(self, stage, profiler='cprofile'):
+        """Profiles every run of the stage with cProfile or the sampling profiler"""
+        if profiler not in PROFILERS:
+            raise ValueError('profiler must be one of {}'.format(', '.join(PROFILERS)))
+        self.profile_stage = stage
+        self.profiler = cProfile.Profile() if profiler == 'cprofile' else SamplingProfiler()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None, **labels):
+        """Records the stage run within the context, the yielded record takes rows_out"""
+        record = {
+            'stage': name,
+            'parent': self.stack[-1]['stage'] if self.stack else None,
+            **labels,
+            'rows_in': rows_in,
+            'rows_out': None,
+        }
+        is_profiled = name == self.profile_stage and not any(
+            parent['stage'] == name for parent in self.stack
+        )
+        self.stack.append(record)
+        start_rss = peak_rss_mb()
+        start = time.perf_counter()
+        if is_profiled:
+            self.profiler.enable()
+        try:
+            yield record
+        finally:
+            if is_profiled:
+                self.profiler.disable()
+            record['start'] = start - self.started
+            record['seconds'] = time.perf_counter() - start
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_growth_mb'] = record['peak_rss_mb'] - start_rss
+            self.stack.pop()
+            self.records.append(record)
+
+    def profile_report(self):
+        if self.profiler is None:
+            return None
+        if isinstance(self.profiler, SamplingProfiler):
+            return {'stage': self.profile_stage, 'profiler': 'sampling', **self.profiler.report()}
+        stats_text = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stats_text)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        return {
+            'stage': self.profile_stage,
+            'profiler': 'cprofile',
+            'stats': stats_text.getvalue(),
+        }
+
+    def summary(self):
+        """Returns the totals of each stage, in the order that the stages first finished"""
+        totals = defaultdict(lambda: {
+            'runs': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+            'rows_in': 0,
+            'rows_out': 0,
+            'peak_rss_mb': 0.0,
+        })
+        for record in self.records:
+            total = totals[record['stage']]
+            total['runs'] += 1
+            total['seconds'] += record['seconds']
+            total['max_seconds'] = max(total['max_seconds'], record['seconds'])
+            total['rows_in'] += record['rows_in'] or 0
+            total['rows_out'] += record['rows_out'] or 0
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+        return dict(totals)
+
+    def summary_text(self):
+        lines = [
+            'Run started {} took {:.1f}s, peak RSS {:.0f} MB'.format(
+                self.started_at.isoformat(timespec='seconds'),
+                time.perf_counter() - self.started,
+                peak_rss_mb(),
+            ),
+            '{:<32} {:>6} {:>10} {:>10} {:>12} {:>12} {:>10}'.format(
+                'stage', 'runs', 'total s', 'max s', 'rows in', 'rows out', 'peak MB',
+            ),
+        ]
+        for stage, total in self.summary().items():
+            lines.append('{:<32} {:>6} {:>10.3f} {:>10.3f} {:>12} {:>12} {:>10.0f}'.format(
+                stage,
+                total['runs'],
+                total['seconds'],
+                total['max_seconds'],
+                total['rows_in'],
+                total['rows_out'],
+                total['peak_rss_mb'],
+            ))
+        profile = self.profile_report()
+        if profile is not None:
+            lines.append('')
+            lines.append('Profile of {} ({})'.format(profile['stage'], profile['profiler']))
+            if profile['profiler'] == 'cprofile':
+                lines.append(profile['stats'])
+            else:
+                for function in profile['inclusive']:
+                    lines.append('{:>8} {}'.format(function['samples'], function['function']))
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path):
+        """Writes the run report to {path}.json and the text summary to {path}.txt"""
+        with open(path + '.json', 'w') as report_file:
+            json.dump({
+                'started': self.started_at.isoformat(timespec='seconds'),
+                'seconds': time.perf_counter() - self.started,
+                'peak_rss_mb': peak_rss_mb(),
+                'summary': self.summary(),
+                'records': self.records,
+                'profile': self.profile_report(),
+            }, report_file, indent=2, default=str)
+        summary_text = self.summary_text()
+        with open(path + '.txt', 'w') as summary_file:
+            summary_file.write(summary_text)
+        return summary_text
+
+
+recorder = Recorder()
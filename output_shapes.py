@@ -1,27 +1,39 @@
-import csv
 import json
 import numpy as np
-import partridge as ptg
-import pandas as pd
-import numpy as np
-import os
+
+from feed_store import load_shapes
 
 
+# Writes the shapes of the busiest date of a feed as GeoJSON line strings for catviz. The
+# shapes, trips and routes are opened from the feed's store (see feed_store.py), which is
+# compiled from the zip on the first run.
 
-def get_feed_df(inpath):
-    print(inpath)
-    _date, service_ids = ptg.read_busiest_date(inpath)
-    # assume it'll be a typical weekday; GO rail is the same every weekday
-    view = {
-        'trips.txt': {'service_id': service_ids},
+def get_shapes_geojson(shapes_df):
+    """Returns a GeoJSON feature collection with a line string of each shape, shapes_df is
+    sorted by shape_id and shape_pt_sequence"""
+    shape_ids = shapes_df['shape_id'].to_numpy()
+    is_first = np.ones(len(shape_ids), dtype=bool)
+    is_first[1:] = shape_ids[1:] != shape_ids[:-1]
+    starts = np.flatnonzero(is_first)
+    ends = np.append(starts[1:], len(shapes_df))
+    coordinates = np.column_stack([shapes_df['shape_pt_lon'], shapes_df['shape_pt_lat']]).tolist()
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': {'shape_id': shape_ids[start]},
+                'geometry': {'type': 'LineString', 'coordinates': coordinates[start:end]},
+            }
+            for start, end in zip(starts, ends)
+        ],
     }
-    feed = ptg.load_geo_feed(inpath, view)
-    return feed
 
 inpath = 'YRT'
-yrt_df = get_feed_df('gtfs_winter_2019/'+inpath+'.zip')
-print(yrt_df.shapes.head())
-print(yrt_df.routes.head())
-print(yrt_df.trips.head())
+yrt_df = load_shapes('gtfs_winter_2019/'+inpath+'.zip')
+print(yrt_df['shapes'].head())
+print(yrt_df['routes'].head())
+print(yrt_df['trips'].head())
 
-yrt_df.shapes.to_file("../catviz/src/res/yrt.geo.json", driver='GeoJSON')
+with open("../catviz/src/res/yrt.geo.json", 'w') as geojson_file:
+    json.dump(get_shapes_geojson(yrt_df['shapes']), geojson_file)
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+import trip_connections
+from feed_cache import load_frames, save_frames
+from instrumentation import recorder
+from transfer_rules import get_station_transfer_rules, read_transfer_rules
+
+
+# Incremental version of the trip_connections script, run with python pipeline.py.
+# The analysis is split into stages:
+#   feeds -> nearby stops of each station -> nearby stop times of each station and date
+#   -> connections of each station and date -> workbooks
+# and each stage's output is stored in the cache_path under a key hashing the stage's
+# inputs, including the keys of the stages it depends on. Changing a transfer window or
+# a station's corridors only reruns the connections of the affected stations and the
+# workbooks, and the feeds are only loaded when a stage needs them.
+
+# bump whenever a stage changes the dataframes that it produces
+PIPELINE_VERSION = 3
+
+
+def stage_key(stage, *inputs):
+    key = {'stage': stage, 'version': PIPELINE_VERSION, 'inputs': inputs}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class LazyFeeds:
+    """Loads the network the first time that a stage needs it"""
+
+    def __init__(self, input_dict, date_strs, stream_stations, location_overrides, station_distances=None):
+        self.input_dict = input_dict
+        self.date_strs = date_strs
+        self.stream_stations = stream_stations
+        self.location_overrides = location_overrides
+        # walking distances of the stops near each station, straight-line if None
+        self.station_distances = station_distances
+        self.network = None
+
+    def key(self):
+        return trip_connections.get_feeds_key(
+            self.date_strs,
+            self.stream_stations,
+            self.location_overrides,
+            self.input_dict['connection_max_distance'],
+            self.input_dict.get('gtfs_directory'),
+        )
+
+    def load(self):
+        if self.network is not None:
+            return self.network
+        self.network = trip_connections.Network.load(
+            date_strs=self.date_strs,
+            cache_path=self.input_dict.get('cache_path'),
+            workers=self.input_dict.get('feed_workers', 1),
+            missing_service=self.input_dict.get('missing_service', 'prompt'),
+            stream_stations=self.stream_stations,
+            location_overrides=self.location_overrides,
+            connection_max_distance=self.input_dict['connection_max_distance'],
+            directory=self.input_dict.get('gtfs_directory'),
+        )
+        if self.station_distances is not None:
+            self.network.set_station_distances(self.station_distances)
+        return self.network
+
+    def select(self, date_str):
+        network = self.load()
+        network.select_service_date(date_str)
+        return network
+
+
+def get_service_dates(cache_path, feeds, feeds_key):
+    key = stage_key('service_dates', feeds_key)
+    frames = load_frames(cache_path, key)
+    if frames is None:
+        frames = {'service_dates': pd.DataFrame({'date': feeds.load().service_dates()})}
+        save_frames(cache_path, key, frames)
+    return list(frames['service_dates']['date'])
+
+
+def get_station_nearby_stops(
+    cache_path,
+    feeds,
+    feeds_key,
+    station_name,
+    location_overrides,
+    connection_max_distance,
+):
+    """Returns the key, station stops and nearby stops (None if the station doesn't
+    exist) of the station"""
+    key = stage_key(
+        'nearby_stops',
+        feeds_key,
+        station_name,
+        location_overrides,
+        connection_max_distance,
+        # walking_distances_key of the walking distances used
+        None if feeds.station_distances is None else feeds.station_distances.key,
+    )
+    frames = load_frames(cache_path, key)
+    if frames is None:
+        network = feeds.load()
+        station_stops = network.station_stops(station_name, location_overrides)
+        frames = {'station_stops': station_stops}
+        if len(station_stops) > 0:
+            frames['nearby_stops'] = network.nearby_stops(
+                station_name,
+                station_stops,
+                connection_max_distance,
+            )
+        save_frames(cache_path, key, frames)
+    return key, frames['station_stops'], frames.get('nearby_stops')
+
+
+def get_date_nearby_stop_times(cache_path, feeds, date_str, station_nearby_stops):
+    """Given the nearby stops key and dataframe of each station, returns the key and
+    nearby trip stop times of each station on the date. Stations whose stop times aren't
+    cached are joined to the stop times together."""
+    station_keys = {
+        station_name: stage_key('nearby_stop_times', nearby_stops_key, date_str)
+        for station_name, (nearby_stops_key, _) in station_nearby_stops.items()
+    }
+    station_frames = {
+        station_name: load_frames(cache_path, key)
+        for station_name, key in station_keys.items()
+    }
+    missing_station_names = [
+        station_name for station_name, frames in station_frames.items() if frames is None
+    ]
+    if len(missing_station_names) > 0:
+        nearby_stop_times_by_station = feeds.select(date_str).all_nearby_trip_stop_times({
+            station_name: station_nearby_stops[station_name][1]
+            for station_name in missing_station_names
+        })
+        for station_name, nearby_stop_times_df in nearby_stop_times_by_station.items():
+            frames = {'nearby_stop_times': nearby_stop_times_df}
+            save_frames(cache_path, station_keys[station_name], frames)
+            station_frames[station_name] = frames
+    return {
+        station_name: (station_keys[station_name], frames['nearby_stop_times'])
+        for station_name, frames in station_frames.items()
+    }
+
+
+def get_station_connections(
+    cache_path,
+    feeds,
+    nearby_stop_times_key,
+    station_name,
+    station_stops,
+    nearby_stop_times_df,
+    corridor_route_ids,
+    station_connection_args,
+):
+    """Returns the key and connections table of the station on a date"""
+    key = stage_key(
+        'connections',
+        nearby_stop_times_key,
+        corridor_route_ids,
+        station_connection_args,
+    )
+    frames = load_frames(cache_path, key)
+    if frames is None:
+        trip_sequences = None
+        if station_connection_args.get('write_raw_csv', False):
+            # the stops lists of the raw CSV are built from the network's stop sequences
+            trip_sequences = feeds.load().trip_sequences
+        frames = {'connections': trip_connections.get_station_connections(
+            station_name,
+            station_stops,
+            nearby_stop_times_df,
+            corridor_route_ids,
+            trip_sequences=trip_sequences,
+            **station_connection_args,
+        )}
+        save_frames(cache_path, key, frames)
+    return key, frames['connections']
+
+
+def get_output_state(path):
+    stat = os.stat(path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def read_outputs(cache_path):
+    """Returns dict of output path -> key and state of the file when last written"""
+    outputs_path = os.path.join(cache_path, 'outputs.json')
+    if not os.path.exists(outputs_path):
+        return {}
+    with open(outputs_path) as outputs_file:
+        return json.load(outputs_file)
+
+
+def output_if_changed(cache_path, key, path, output):
+    """Calls output unless the file (or directory) at path is still the one it last wrote,
+    with the same key. Changing the file in any other way, e.g. writing it with
+    trip_connections.py, writes it again on the next run."""
+    outputs = read_outputs(cache_path)
+    output_path = os.path.normpath(path)
+    if os.path.exists(path) and outputs.get(output_path) == {'key': key, **get_output_state(path)}:
+        print('Unchanged', path)
+        return
+    output()
+    outputs[output_path] = {'key': key, **get_output_state(path)}
+    os.makedirs(cache_path, exist_ok=True)
+    tmp_path = os.path.join(cache_path, 'outputs.json.tmp')
+    with open(tmp_path, 'w') as outputs_file:
+        json.dump(outputs, outputs_file, indent=2)
+    os.replace(tmp_path, os.path.join(cache_path, 'outputs.json'))
+
+
+def run_pipeline(input_dict, stations, location_overrides):
+    cache_path = input_dict.get('cache_path') or 'cache'
+    date_strs = trip_connections.read_config_dates(input_dict)
+    is_multi_day = date_strs is not None and len(date_strs) > 1
+    station_names = [station_name for station_name in stations if station_name != '']
+    feeds = LazyFeeds(
+        input_dict,
+        date_strs,
+        station_names if input_dict.get('stream_stop_times', False) else None,
+        location_overrides,
+        trip_connections.read_station_distances(input_dict, stations, location_overrides),
+    )
+    feeds_key = feeds.key()
+    service_date_strs = get_service_dates(cache_path, feeds, feeds_key)
+    if not is_multi_day:
+        analysis_date_strs = service_date_strs[:1]
+    else:
+        analysis_date_strs = [
+            date_str for date_str in date_strs if date_str in service_date_strs
+        ]
+    # the classification settings, connection_max_distance only affects the nearby stops
+    station_connection_args = dict(
+        min_inbound_minutes=input_dict['min_inbound_minutes'],
+        max_inbound_minutes=input_dict['max_inbound_minutes'],
+        min_outbound_minutes=input_dict['min_outbound_minutes'],
+        max_outbound_minutes=input_dict['max_outbound_minutes'],
+        only_show_corridors=input_dict['only_show_corridors'],
+        hourly_summary=input_dict['hourly_summary'],
+        union_station_is_inbound=input_dict.get('union_station_is_inbound', False),
+        write_raw_csv=input_dict.get('write_raw_csv', False),
+    )
+    transfer_rules = read_transfer_rules(input_dict['input_path'])
+
+    station_nearby_stops = {}
+    station_stops_by_name = {}
+    for station_name in station_names:
+        nearby_stops_key, station_stops, nearby_stops_df = get_station_nearby_stops(
+            cache_path,
+            feeds,
+            feeds_key,
+            station_name,
+            location_overrides.get(station_name, []),
+            input_dict['connection_max_distance'],
+        )
+        if nearby_stops_df is not None:
+            station_stops_by_name[station_name] = station_stops
+            station_nearby_stops[station_name] = (nearby_stops_key, nearby_stops_df)
+
+    date_connections = []
+    all_connections_keys = []
+    for date_str in analysis_date_strs:
+        nearby_stop_times = get_date_nearby_stop_times(
+            cache_path,
+            feeds,
+            date_str,
+            station_nearby_stops,
+        )
+        station_connections = [trip_connections.empty_connections_df()]
+        connections_keys = []
+        for station_name in station_names:
+            if station_name not in nearby_stop_times:
+                # station doesn't exist, no connections
+                continue
+            nearby_stop_times_key, nearby_stop_times_df = nearby_stop_times[station_name]
+            connections_key, connections_df = get_station_connections(
+                cache_path,
+                feeds,
+                nearby_stop_times_key,
+                station_name,
+                station_stops_by_name[station_name],
+                nearby_stop_times_df,
+                stations[station_name],
+                # only the station's own rules are part of its connections key
+                dict(
+                    station_connection_args,
+                    transfer_rules=get_station_transfer_rules(transfer_rules, station_name),
+                ),
+            )
+            connections_keys.append(connections_key)
+            station_connections.append(connections_df)
+        connections_df = pd.concat(station_connections, ignore_index=True)
+        path = './output/transit_connections.xlsx'
+        if is_multi_day:
+            path = './output/transit_connections_{date}.xlsx'.format(date=date_str)
+        output_if_changed(
+            cache_path,
+            stage_key('workbook', connections_keys, station_names, path),
+            path,
+            lambda: trip_connections.output_workbook(connections_df, station_names, path),
+        )
+        if input_dict.get('export_parquet', False):
+            from connections_export import export_connections, get_date_path
+            output_if_changed(
+                cache_path,
+                stage_key('export_connections', connections_keys, date_str),
+                get_date_path('connections', date_str),
+                lambda: export_connections(connections_df, date_str),
+            )
+        date_connections.append(connections_df.assign(date=date_str))
+        all_connections_keys.append(connections_keys)
+
+    if is_multi_day:
+        path = './output/transit_connections_summary.xlsx'
+        output_if_changed(
+            cache_path,
+            stage_key('summary', all_connections_keys, station_names, analysis_date_strs, path),
+            path,
+            lambda: trip_connections.output_summary_workbook(
+                trip_connections.get_connections_summary(
+                    pd.concat(date_connections, ignore_index=True),
+                    station_names,
+                    analysis_date_strs,
+                ),
+                path,
+            ),
+        )
+
+
+if __name__ == '__main__':
+    input_dict = trip_connections.read_config()
+    if input_dict.get('profile_stage'):
+        recorder.set_profiler(input_dict['profile_stage'], input_dict.get('profiler', 'cprofile'))
+    run_pipeline(
+        input_dict,
+        trip_connections.read_stations(input_dict['input_path']),
+        trip_connections.read_location_overrides(input_dict['input_path']),
+    )
+    print(recorder.write_report('./output/run_report'))
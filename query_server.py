@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+import traceback
+import numpy as np
+from urllib.parse import parse_qs, urlsplit
+
+import trip_connections
+from clocktime import clocktime_to_seconds
+from transfer_rules import get_station_transfer_rules, read_transfer_rules
+
+
+# Local HTTP server answering connectivity queries as JSON, run with python query_server.py.
+# The network is loaded once, and each service date is selected (indexing its stop times
+# by stop and departure time) the first time that it is queried.
+#
+#   GET /trips?stop_name=...&start=10:00&end=14:00
+#   GET /trips?agency=...&stop_id=...&start=10:00&end=14:00
+#       number of trips departing the stop(s) in [start, end), in total and by route
+#   GET /hourly?stop_name=... (or agency and stop_id)
+#       number of trips departing the stop(s) in each hour after midnight
+#   GET /connections?station=...[&corridors=1,2][&min_inbound_minutes=5...]
+#       connections table of the station, the corridors default to Stations.csv and the
+#       transfer windows to config.json, overridden by the rules of TransferRules.csv
+#       unless given in the query
+#   GET /routes?lat=...&lon=...&radius=400
+#       routes with a stop within radius metres of the point
+#
+# Every query also takes an optional date (YYYY-MM-DD) when config.json has several dates.
+# Invalid queries get a 400 response and unexpected errors a 500, both with a JSON error.
+
+TRANSFER_WINDOWS = [
+    'min_inbound_minutes',
+    'max_inbound_minutes',
+    'min_outbound_minutes',
+    'max_outbound_minutes',
+]
+
+
+class QueryError(Exception):
+    """Raised for invalid queries, returned as a 400 response"""
+
+
+class QueryServer:
+
+    def __init__(self, network, input_dict, stations, location_overrides, date_strs, transfer_rules=()):
+        """network is a trip_connections.Network loaded with keep_dates, so that every
+        queried date is only indexed once, transfer_rules are the rules of
+        read_transfer_rules"""
+        self.network = network
+        self.input_dict = input_dict
+        self.stations = stations
+        self.location_overrides = location_overrides
+        self.transfer_rules = transfer_rules
+        # the queries run in threads off the event loop, one at a time as selecting a date
+        # changes the network
+        self.lock = threading.Lock()
+        self.date_strs = network.service_dates()
+        if date_strs is not None:
+            self.date_strs = [date_str for date_str in date_strs if date_str in self.date_strs]
+
+    def select_date(self, query):
+        """Selects the queried (or first) date, returns the index of its stop times"""
+        date_str = get_param(query, 'date', self.date_strs[0])
+        if date_str not in self.date_strs:
+            raise QueryError('No service loaded for date {}'.format(date_str))
+        self.network.select_service_date(date_str)
+        return self.network.stop_time_index
+
+    def get_stop_keys(self, query):
+        """Returns the keys of the stops with the queried stop_name, or agency and stop_id"""
+        stops_df = self.network.stops_df
+        if 'stop_name' in query:
+            is_stop = stops_df['stop_name'] == get_param(query, 'stop_name')
+        else:
+            is_stop = (
+                (stops_df['agency'] == get_param(query, 'agency'))
+                & (stops_df['stop_id'] == get_param(query, 'stop_id'))
+            )
+        stop_keys = np.flatnonzero(is_stop.to_numpy())
+        if len(stop_keys) == 0:
+            raise QueryError('No such stop')
+        return stop_keys
+
+    def get_trips(self, query):
+        stop_keys = self.get_stop_keys(query)
+        start = clocktime_to_seconds(get_param(query, 'start', '00:00'))
+        end = clocktime_to_seconds(get_param(query, 'end', '48:00'))
+        stop_time_index = self.select_date(query)
+        trip_keys = stop_time_index.trips(stop_keys, start, end)
+        trips_df = self.network.trips_df.take(trip_keys)
+        routes_df = self.network.routes_df.take(trips_df['route_key'])
+        # observed only lists the routes that occur if the columns are categorical
+        route_trips = routes_df.groupby(['agency', 'route_short_name'], observed=True).size()
+        return {
+            'stops': len(stop_keys),
+            'trips': len(trips_df),
+            'routes': [
+                {'agency': agency, 'route': str(route), 'trips': int(trips)}
+                for (agency, route), trips in route_trips.items()
+            ],
+        }
+
+    def get_hourly(self, query):
+        stop_keys = self.get_stop_keys(query)
+        stop_time_index = self.select_date(query)
+        return {
+            'stops': len(stop_keys),
+            'hourly_trips': stop_time_index.hourly_histogram(stop_keys).tolist(),
+        }
+
+    def get_connections(self, query):
+        station_name = get_param(query, 'station')
+        station_stops = self.network.station_stops(
+            station_name,
+            self.location_overrides.get(station_name, []),
+        )
+        if len(station_stops) == 0:
+            raise QueryError('No such station')
+        corridor_route_ids = self.stations.get(station_name, [])
+        if 'corridors' in query:
+            corridor_route_ids = get_param(query, 'corridors').split(',')
+        windows = {
+            window: float(get_param(query, window, self.input_dict[window]))
+            for window in TRANSFER_WINDOWS
+        }
+        # windows given in the query apply to every trip, whatever the transfer rules set
+        transfer_rules = [
+            dict(rule, **{window: None for window in TRANSFER_WINDOWS if window in query})
+            for rule in get_station_transfer_rules(self.transfer_rules, station_name)
+        ]
+        self.select_date(query)
+        nearby_stops_df = self.network.nearby_stops(
+            station_name,
+            station_stops,
+            float(get_param(query, 'radius', self.input_dict['connection_max_distance'])),
+        )
+        connections_df = trip_connections.get_station_connections(
+            station_name,
+            station_stops,
+            self.network.station_nearby_stop_times(nearby_stops_df),
+            corridor_route_ids,
+            only_show_corridors=self.input_dict['only_show_corridors'],
+            hourly_summary=self.input_dict['hourly_summary'],
+            union_station_is_inbound=self.input_dict.get('union_station_is_inbound', False),
+            transfer_rules=transfer_rules,
+            write_raw_csv=False,
+            **windows,
+        )
+        return {
+            'station': station_name,
+            'corridors': corridor_route_ids,
+            'connections': json.loads(connections_df.to_json(orient='records')),
+        }
+
+    def get_routes(self, query):
+        lat = float(get_param(query, 'lat'))
+        lon = float(get_param(query, 'lon'))
+        radius = float(get_param(query, 'radius', self.input_dict['connection_max_distance']))
+        stop_keys, _ = self.network.stops_index.within([lat], [lon], radius)
+        stop_time_index = self.select_date(query)
+        trip_keys = stop_time_index.trips(stop_keys)
+        route_keys = np.unique(self.network.trips_df['route_key'].to_numpy()[trip_keys])
+        routes_df = self.network.routes_df.take(route_keys)
+        return {
+            'stops': len(stop_keys),
+            'routes': [
+                {'agency': agency, 'route_id': str(route_id), 'route': str(route)}
+                for agency, route_id, route in zip(
+                    routes_df['agency'],
+                    routes_df['route_id'],
+                    routes_df['route_short_name'],
+                )
+            ],
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # skip the headers, the queries have no body
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            status, body = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.respond,
+                request_line,
+            )
+            payload = json.dumps(body).encode('utf-8')
+            writer.write((
+                'HTTP/1.1 {status}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {length}\r\n'
+                'Connection: close\r\n\r\n'
+            ).format(status=status, length=len(payload)).encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def respond(self, request_line):
+        """Returns the status and JSON body of the response to the request"""
+        if len(request_line) < 2 or request_line[0] != 'GET':
+            return '405 Method Not Allowed', {'error': 'Only GET is supported'}
+        url = urlsplit(request_line[1])
+        handlers = {
+            '/trips': self.get_trips,
+            '/hourly': self.get_hourly,
+            '/connections': self.get_connections,
+            '/routes': self.get_routes,
+        }
+        if url.path not in handlers:
+            return '404 Not Found', {'error': 'Unknown path {}'.format(url.path)}
+        try:
+            with self.lock:
+                return '200 OK', handlers[url.path](parse_qs(url.query))
+        except (QueryError, ValueError) as error:
+            return '400 Bad Request', {'error': str(error)}
+        except Exception as error:
+            traceback.print_exc()
+            return '500 Internal Server Error', {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+def get_param(query, name, default=None):
+    if name not in query:
+        if default is None:
+            raise QueryError('Missing parameter {}'.format(name))
+        return default
+    return query[name][0]
+
+
+async def serve(query_server, host, port):
+    server = await asyncio.start_server(query_server.handle, host, port)
+    print('Serving queries on', host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    input_dict = trip_connections.read_config()
+    date_strs = trip_connections.read_config_dates(input_dict)
+    network = trip_connections.Network.load(
+        date_strs=date_strs,
+        cache_path=input_dict.get('cache_path'),
+        workers=input_dict.get('feed_workers', 1),
+        missing_service=input_dict.get('missing_service', 'prompt'),
+        keep_dates=True,
+        directory=input_dict.get('gtfs_directory'),
+    )
+    stations = trip_connections.read_stations(input_dict['input_path'])
+    location_overrides = trip_connections.read_location_overrides(input_dict['input_path'])
+    station_distances = trip_connections.read_station_distances(input_dict, stations, location_overrides)
+    if station_distances is not None:
+        network.set_station_distances(station_distances)
+    query_server = QueryServer(
+        network,
+        input_dict,
+        stations,
+        location_overrides,
+        date_strs,
+        read_transfer_rules(input_dict['input_path']),
+    )
+    asyncio.run(serve(
+        query_server,
+        input_dict.get('query_server_host', '127.0.0.1'),
+        input_dict.get('query_server_port', 8080),
+    ))
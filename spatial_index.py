@@ -0,0 +1,94 @@
+import numpy as np
+
+
+# Grid-bucket spatial index over the stops of every loaded feed, so that radius searches
+# around a station only compute distances to the stops in the surrounding grid cells.
+
+EARTH_RADIUS_METRES = 3959 * 1.6 * 1000 # same radius as haversine
+METRES_PER_DEGREE = EARTH_RADIUS_METRES * np.pi / 180
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    MILES = 3959
+    lat1, lon1, lat2, lon2 = map(np.deg2rad, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    total_miles = MILES * c
+    return total_miles * 1.6 * 1000 # return metres
+
+
+class StopIndex:
+    """Buckets stop positions (row positions of the stops dataframe) into grid cells of
+    roughly cell_size metres"""
+
+    def __init__(self, stop_lats, stop_lons, cell_size=500):
+        self.stop_lats = np.asarray(stop_lats, dtype=float)
+        self.stop_lons = np.asarray(stop_lons, dtype=float)
+        located = np.flatnonzero(~np.isnan(self.stop_lats) & ~np.isnan(self.stop_lons))
+        self.cell_lat = cell_size / METRES_PER_DEGREE
+        # longitude cells are sized at the most poleward stop so they are never too small
+        max_abs_lat = np.abs(self.stop_lats[located]).max() if len(located) else 0
+        self.cell_lon = self.cell_lat / max(np.cos(np.deg2rad(max_abs_lat)), 1e-6)
+
+        rows = np.floor(self.stop_lats[located] / self.cell_lat).astype(np.int64)
+        cols = np.floor(self.stop_lons[located] / self.cell_lon).astype(np.int64)
+        order = np.lexsort((cols, rows))
+        rows, cols, positions = rows[order], cols[order], located[order]
+        is_first = np.ones(len(positions), dtype=bool)
+        is_first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        starts = np.flatnonzero(is_first)
+        ends = np.append(starts[1:], len(positions))
+        self.positions = positions
+        self.cells = {
+            (rows[start], cols[start]): (start, end)
+            for start, end in zip(starts, ends)
+        }
+
+    def candidates(self, lat, lon, radius):
+        """Returns the positions of stops in every grid cell within radius of the point"""
+        # small margin as the haversine bounds on latitude/longitude are not exact
+        dlat = radius * 1.01 / METRES_PER_DEGREE
+        dlon = dlat / max(np.cos(np.deg2rad(min(abs(lat) + dlat, 89.9))), 1e-6)
+        first_row = int(np.floor((lat - dlat) / self.cell_lat))
+        last_row = int(np.floor((lat + dlat) / self.cell_lat))
+        first_col = int(np.floor((lon - dlon) / self.cell_lon))
+        last_col = int(np.floor((lon + dlon) / self.cell_lon))
+        ranges = [
+            self.cells[(row, col)]
+            for row in range(first_row, last_row + 1)
+            for col in range(first_col, last_col + 1)
+            if (row, col) in self.cells
+        ]
+        if len(ranges) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.positions[start:end] for start, end in ranges])
+
+    def distances(self, positions, lats, lons):
+        """Returns the distance from each stop position to the closest of the given points"""
+        positions = np.asarray(positions, dtype=np.int64)
+        distances = np.full(len(positions), np.inf)
+        for lat, lon in zip(lats, lons):
+            distances = np.fmin(distances, haversine(
+                lat,
+                lon,
+                self.stop_lats[positions],
+                self.stop_lons[positions],
+            ))
+        return distances
+
+    def within(self, lats, lons, radius):
+        """Returns (positions, distances) of the stops within radius metres of any of the
+        given points, with the distance to the closest point"""
+        candidates = [
+            self.candidates(lat, lon, radius)
+            for lat, lon in zip(lats, lons)
+            if not (np.isnan(lat) or np.isnan(lon))
+        ]
+        if len(candidates) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=float)
+        positions = np.unique(np.concatenate(candidates))
+        distances = self.distances(positions, lats, lons)
+        is_within = distances <= radius
+        return positions[is_within], distances[is_within]
@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import trip_connections
+from feed_store import decode_text, encode_text
+from instrumentation import recorder
+from stop_time_index import StopTimeIndex
+
+
+# Classifies the stations of the network's selected date in parallel worker processes.
+# The stops, trips, routes and selected stop times are copied once into shared memory,
+# numeric columns as they are and text columns as integer codes, with only the
+# dictionaries of their strings sent to the workers (encoded as in the feed store, see
+# feed_store.py). Each worker rebuilds the network on views of the shared numeric blocks,
+# so the stop times are neither pickled per station nor copied per worker, and memory
+# stays flat as workers are added. Text columns are decoded into object columns by each
+# worker, as grouping on categoricals is far slower. Stations are sent one at a time and their
+# connections come back in the order of the stations given.
+
+# network rebuilt by each worker, and the shared blocks its frames are views of
+worker_network = None
+worker_blocks = []
+
+
+class SharedTables:
+    """Shared memory blocks holding the arrays given, unlinked when closed"""
+
+    def __init__(self):
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def share_array(self, array):
+        """Copies the array into a new block, returns its spec for attach_array"""
+        array = np.ascontiguousarray(array)
+        # blocks can't be empty
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        return {'name': block.name, 'dtype': array.dtype.str, 'shape': array.shape}
+
+    def share_frame(self, df):
+        """Shares each column of the dataframe, returns its spec for attach_frame"""
+        columns = []
+        for column in df.columns:
+            values = df[column]
+            if values.dtype.kind in 'biuf':
+                columns.append((column, self.share_array(values.to_numpy()), None))
+            else:
+                codes, dictionary = encode_text(values)
+                columns.append((column, self.share_array(codes), dictionary))
+        return {'columns': columns, 'length': len(df)}
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_array(spec):
+    block = shared_memory.SharedMemory(name=spec['name'])
+    # the block must stay open for as long as the views on it are used
+    worker_blocks.append(block)
+    return np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=block.buf)
+
+
+def attach_frame(spec):
+    """Returns the shared dataframe, its columns are views of the shared blocks"""
+    columns = {}
+    for column, array_spec, dictionary in spec['columns']:
+        values = attach_array(array_spec)
+        if dictionary is not None:
+            values = decode_text(values, dictionary)
+        columns[column] = values
+    # without copy=False the columns are consolidated into new 2D blocks
+    return pd.DataFrame(columns, index=pd.RangeIndex(spec['length']), copy=False)
+
+
+def share_network(shared, network, share_trip_sequences=False):
+    """Shares the network's frames and the selected date's stop times and index, returns
+    the spec that init_worker rebuilds the network from. The trip stop sequences are only
+    shared if share_trip_sequences, as only the raw CSV reads them."""
+    frames = {
+        'stops': network.stops_df,
+        'trips': network.trips_df,
+        'routes': network.routes_df,
+        'stop_times': network.stop_times_df,
+    }
+    if share_trip_sequences and network.trip_sequences is not None:
+        frames.update(network.trip_sequences.to_frames())
+    return {
+        'date': network.date_str,
+        'frames': {name: shared.share_frame(df) for name, df in frames.items()},
+        'stop_time_index': {
+            name: shared.share_array(array)
+            for name, array in network.stop_time_index.to_arrays().items()
+        },
+        'service_dates': network.service_dates_df,
+        'anomalies': network.anomalies_df,
+        'station_distances': network.station_distances,
+    }
+
+
+def init_worker(spec):
+    global worker_network
+    frames = {name: attach_frame(frame_spec) for name, frame_spec in spec['frames'].items()}
+    frames['service_dates'] = spec['service_dates']
+    frames['anomalies'] = spec['anomalies']
+    # the worker only has the selected date's stop times
+    worker_network = trip_connections.Network(frames)
+    # already mapped to the stop keys of the shared stops
+    worker_network.station_distances = spec['station_distances']
+    worker_network.set_date_stop_times(
+        spec['date'],
+        frames['stop_times'],
+        StopTimeIndex.from_arrays({
+            name: attach_array(array_spec)
+            for name, array_spec in spec['stop_time_index'].items()
+        }),
+    )
+    worker_network.select_service_date(spec['date'])
+
+
+def get_worker_connections(station_name, corridor_route_ids, location_overrides, station_connection_args):
+    """Returns the station's connections along with the records of its stages"""
+    first_record = len(recorder.records)
+    connections_df = worker_network.connections(
+        station_name=station_name,
+        corridor_route_ids=corridor_route_ids,
+        location_overrides=location_overrides,
+        **station_connection_args,
+    )
+    records = recorder.records[first_record:]
+    del recorder.records[first_record:]
+    return connections_df, records
+
+
+def get_parallel_connections(
+    network,
+    stations,
+    station_names,
+    location_overrides,
+    workers,
+    **station_connection_args,
+):
+    """Returns the connections table of every station for the network's selected date,
+    with the stations classified by worker processes, in the order of station_names"""
+    with SharedTables() as shared:
+        spec = share_network(
+            shared,
+            network,
+            station_connection_args.get('write_raw_csv', False),
+        )
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(spec,),
+        ) as executor:
+            station_connections = [trip_connections.empty_connections_df()]
+            for connections_df, records in executor.map(
+                get_worker_connections,
+                station_names,
+                [stations[station_name] for station_name in station_names],
+                [location_overrides.get(station_name, []) for station_name in station_names],
+                [station_connection_args] * len(station_names),
+            ):
+                station_connections.append(connections_df)
+                recorder.records.extend(records)
+    return pd.concat(station_connections, ignore_index=True)
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+# Index of the stop times by stop and departure time, so that the trips serving a set of
+# stops within a time window are found with binary searches instead of scanning every
+# stop time. The stop times of the stop with key i are at offsets[i]:offsets[i+1] of the
+# sorted arrays.
+
+SECONDS_PER_HOUR = 60*60
+
+
+class StopTimeIndex:
+
+    def __init__(self, stop_keys, trip_keys, departure_times, stop_count):
+        """Takes the stop_key, trip_key and departure time (seconds) of each stop time, and
+        the number of stop keys"""
+        stop_keys = np.asarray(stop_keys)
+        departure_times = np.asarray(departure_times, dtype=float)
+        order = np.lexsort((departure_times, stop_keys))
+        # row positions of the stop times given, in index order
+        self.rows = order
+        self.trip_keys = np.asarray(trip_keys)[order]
+        self.departure_times = departure_times[order]
+        self.offsets = np.zeros(stop_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(stop_keys, minlength=stop_count), out=self.offsets[1:])
+
+    @classmethod
+    def from_stop_times(cls, stop_times_df, stop_count):
+        return cls(
+            stop_times_df['stop_key'],
+            stop_times_df['trip_key'],
+            stop_times_df['departure_time'],
+            stop_count,
+        )
+
+    def to_arrays(self):
+        return {
+            'rows': self.rows,
+            'trip_keys': self.trip_keys,
+            'departure_times': self.departure_times,
+            'offsets': self.offsets,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuilds the index from the arrays of to_arrays, without copying them"""
+        index = cls.__new__(cls)
+        index.rows = arrays['rows']
+        index.trip_keys = arrays['trip_keys']
+        index.departure_times = arrays['departure_times']
+        index.offsets = arrays['offsets']
+        return index
+
+    def positions(self, stop_keys, start=None, end=None):
+        """Returns the index positions of the stop times at the given stops departing in
+        [start, end) seconds (all of them if not given)"""
+        slices = []
+        for stop_key in np.atleast_1d(stop_keys):
+            first = self.offsets[stop_key]
+            departure_times = self.departure_times[first:self.offsets[stop_key + 1]]
+            start_position = 0 if start is None else np.searchsorted(departure_times, start, side='left')
+            end_position = len(departure_times) if end is None else np.searchsorted(departure_times, end, side='left')
+            if start_position < end_position:
+                slices.append(np.arange(first + start_position, first + end_position))
+        if len(slices) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(slices)
+
+    def stop_rows(self, stop_keys, start=None, end=None):
+        """Returns the row positions of the stop times at the given stops departing in
+        [start, end) seconds, in the order of the stop times that the index was built on"""
+        return np.sort(self.rows[self.positions(stop_keys, start, end)])
+
+    def trips(self, stop_keys, start=None, end=None):
+        """Returns the sorted keys of the trips departing any of the given stops in
+        [start, end) seconds"""
+        return np.unique(self.trip_keys[self.positions(stop_keys, start, end)])
+
+    def count(self, stop_keys, start=None, end=None):
+        """Returns the number of trips departing any of the given stops in [start, end)
+        seconds, a trip serving several of the stops is counted once"""
+        return len(self.trips(stop_keys, start, end))
+
+    def hourly_histogram(self, stop_keys):
+        """Returns the number of trips departing any of the given stops in each hour after
+        midnight, with at least 24 hours (more for trips past midnight)"""
+        positions = self.positions(stop_keys)
+        hours = (self.departure_times[positions] // SECONDS_PER_HOUR).astype(np.int64)
+        # a trip serving several of the stops within the hour is counted once
+        trip_hours = np.unique(np.stack([hours, self.trip_keys[positions]]), axis=1)
+        return np.bincount(trip_hours[0], minlength=24)
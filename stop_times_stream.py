@@ -0,0 +1,78 @@
+import zipfile
+import pandas as pd
+
+from clocktime import clocktimes_to_seconds
+from feed_normalize import ANOMALIES, STOP_TIME_COLUMNS, normalize_stop_times
+
+
+# Streams stop_times.txt out of a GTFS zip in chunks, keeping only the stop times at a
+# given set of stops, so that the full stop_times table never has to fit in memory.
+
+NUMERIC_COLUMNS = ['shape_dist_traveled', 'stop_sequence']
+
+
+def find_stop_times_file(gtfs_zip):
+    for name in gtfs_zip.namelist():
+        if name.split('/')[-1] == 'stop_times.txt':
+            return name
+    raise ValueError('No stop_times.txt in GTFS')
+
+
+def stream_stop_times(zip_path, trip_ids, stop_ids, chunksize=500000):
+    """Reads the stop times of the given trips from the GTFS zip, and returns the ones at
+    the given stops along with the number of stops of each trip (indexed by trip_id) and
+    the count of each anomaly.
+
+    Each trip is normalized with normalize_stop_times before filtering, as is done for
+    fully loaded feeds. The stop times of a trip are expected to be consecutive in the
+    file, as GTFS producers write them."""
+    trip_ids = set(trip_ids)
+    stop_ids = set(stop_ids)
+    nearby_chunks = []
+    trip_stop_counts = []
+    anomalies = dict.fromkeys(ANOMALIES, 0)
+
+    def add_trips(trips_stop_times_df):
+        stop_times_df, trips_anomalies = normalize_stop_times(trips_stop_times_df)
+        for anomaly, count in trips_anomalies.items():
+            anomalies[anomaly] += count
+        trip_stop_counts.append(stop_times_df['trip_id'].value_counts())
+        nearby_chunks.append(stop_times_df[stop_times_df['stop_id'].isin(stop_ids)])
+
+    # stop times of the last trip of the previous chunk, which may continue in the next
+    last_trip_df = None
+    with zipfile.ZipFile(zip_path) as gtfs_zip:
+        with gtfs_zip.open(find_stop_times_file(gtfs_zip)) as stop_times_file:
+            reader = pd.read_csv(
+                stop_times_file,
+                dtype=str,
+                encoding='utf-8-sig',
+                index_col=False,
+                chunksize=chunksize,
+            )
+            for chunk in reader:
+                chunk.rename(columns=lambda column: column.strip(), inplace=True)
+                chunk = chunk[chunk['trip_id'].str.strip().isin(trip_ids)]
+                if chunk.empty:
+                    continue
+                for column in chunk.columns:
+                    chunk[column] = chunk[column].str.strip()
+                chunk['arrival_time'] = clocktimes_to_seconds(chunk['arrival_time'])
+                chunk['departure_time'] = clocktimes_to_seconds(chunk['departure_time'])
+                for column in NUMERIC_COLUMNS:
+                    if column in chunk.columns:
+                        chunk[column] = pd.to_numeric(chunk[column])
+                if last_trip_df is not None:
+                    chunk = pd.concat([last_trip_df, chunk])
+                is_last_trip = (chunk['trip_id'] == chunk['trip_id'].iloc[-1]).to_numpy()
+                last_trip_df = chunk[is_last_trip]
+                if not is_last_trip.all():
+                    add_trips(chunk[~is_last_trip])
+    if last_trip_df is not None:
+        add_trips(last_trip_df)
+
+    if len(nearby_chunks) == 0:
+        return pd.DataFrame(columns=STOP_TIME_COLUMNS), pd.Series(dtype=int), anomalies
+    stop_times_df = pd.concat(nearby_chunks, ignore_index=True)
+    trip_stop_counts = pd.concat(trip_stop_counts).groupby(level=0).sum()
+    return stop_times_df, trip_stop_counts, anomalies
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import gtfs_fetch
+
+
+# Tests of gtfs_fetch.py against a local HTTP server standing in for the agencies, run
+# with python -m unittest test_gtfs_fetch (or python -m pytest).
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """Serves the server's feeds (path -> dict of body, etag and truncate), honouring
+    If-None-Match and Range with If-Range. A truncated feed announces its whole length
+    but closes the connection halfway through."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        feed = self.server.feeds.get(self.path)
+        if feed is None:
+            self.send_error(500)
+            return
+        etag = feed.get('etag')
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = feed['body']
+        start = 0
+        if etag is not None and 'Range' in self.headers and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+        self.send_response(206 if start > 0 else 200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if feed.get('truncate'):
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshots_directory = os.path.join(self.directory, 'gtfs_snapshots')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.feeds = {}
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], path)
+
+    def gtfs_config(self, *names):
+        return [{'name': name, 'source': self.url('/' + name + '.zip')} for name in names]
+
+    def fetch_all(self, *names):
+        return gtfs_fetch.fetch_all(self.gtfs_config(*names), self.snapshots_directory, timeout=5)
+
+    def read_snapshot_file(self, snapshot_path, file_name):
+        with open(os.path.join(snapshot_path, file_name), 'rb') as snapshot_file:
+            return snapshot_file.read()
+
+    def test_unchanged_feed_is_not_downloaded_again(self):
+        self.server.feeds['/GRT.zip'] = {'body': b'grt feed', 'etag': '"v1"'}
+        snapshot_path = self.fetch_all('GRT')
+        with open(os.path.join(snapshot_path, gtfs_fetch.MANIFEST)) as manifest_file:
+            entry = json.load(manifest_file)['feeds']['GRT']
+        self.assertEqual(entry['sha256'], hashlib.sha256(b'grt feed').hexdigest())
+        self.assertEqual(entry['etag'], '"v1"')
+
+        self.server.requests.clear()
+        self.assertEqual(self.fetch_all('GRT'), snapshot_path)
+        self.assertEqual(self.server.requests[0][1].get('If-None-Match'), '"v1"')
+        self.assertEqual(gtfs_fetch.get_latest_snapshot(self.snapshots_directory), snapshot_path)
+
+    def test_interrupted_download_resumes_with_if_range(self):
+        # parts are written a chunk at a time, the download stops in the second chunk
+        body = bytes(range(256)) * (3 * gtfs_fetch.CHUNK_SIZE // 256)
+        self.server.feeds['/GRT.zip'] = {'body': body, 'etag': '"v1"', 'truncate': True}
+        part_path = os.path.join(self.directory, 'GRT.zip.part')
+        with requests.Session() as session:
+            with self.assertRaises(requests.RequestException):
+                gtfs_fetch.download(session, self.url('/GRT.zip'), part_path, {}, timeout=5)
+        self.assertTrue(os.path.exists(part_path + '.validator'))
+        partial_size = os.path.getsize(part_path)
+        self.assertGreater(partial_size, 0)
+
+        self.server.feeds['/GRT.zip']['truncate'] = False
+        with requests.Session() as session:
+            response, sha256 = gtfs_fetch.download(session, self.url('/GRT.zip'), part_path, {}, timeout=5)
+        self.assertEqual(response.status_code, 206)
+        headers = self.server.requests[-1][1]
+        self.assertEqual(headers['Range'], 'bytes={}-'.format(partial_size))
+        self.assertEqual(headers['If-Range'], '"v1"')
+        with open(part_path, 'rb') as part_file:
+            self.assertEqual(part_file.read(), body)
+        self.assertEqual(sha256, hashlib.sha256(body).hexdigest())
+        self.assertFalse(os.path.exists(part_path + '.validator'))
+
+    def test_restarted_download_drops_stale_validator(self):
+        part_path = os.path.join(self.directory, 'GRT.zip.part')
+        with open(part_path, 'wb') as part_file:
+            part_file.write(b'old feed')
+        with open(part_path + '.validator', 'w') as validator_file:
+            validator_file.write('"old"')
+        # the source changed and no longer sends validators, and the body is cut short
+        self.server.feeds['/GRT.zip'] = {'body': b'new feed' * 1024, 'truncate': True}
+        with requests.Session() as session:
+            with self.assertRaises(requests.RequestException):
+                gtfs_fetch.download(session, self.url('/GRT.zip'), part_path, {}, timeout=5)
+        self.assertFalse(os.path.exists(part_path + '.validator'))
+
+        # so the next run downloads the whole source instead of appending to the old one
+        self.server.feeds['/GRT.zip']['truncate'] = False
+        with requests.Session() as session:
+            response, sha256 = gtfs_fetch.download(session, self.url('/GRT.zip'), part_path, {}, timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Range', self.server.requests[-1][1])
+        self.assertEqual(sha256, hashlib.sha256(b'new feed' * 1024).hexdigest())
+
+    def test_failed_feed_keeps_previous_version(self):
+        self.server.feeds['/GRT.zip'] = {'body': b'grt feed', 'etag': '"v1"'}
+        self.server.feeds['/HSR.zip'] = {'body': b'hsr feed', 'etag': '"v1"'}
+        previous_snapshot_path = self.fetch_all('GRT', 'HSR')
+
+        self.server.feeds['/GRT.zip'] = {'body': b'grt feed 2', 'etag': '"v2"'}
+        del self.server.feeds['/HSR.zip']
+        snapshot_path = self.fetch_all('GRT', 'HSR')
+        self.assertNotEqual(snapshot_path, previous_snapshot_path)
+        self.assertEqual(self.read_snapshot_file(snapshot_path, 'GRT.zip'), b'grt feed 2')
+        self.assertEqual(self.read_snapshot_file(snapshot_path, 'HSR.zip'), b'hsr feed')
+        with open(os.path.join(snapshot_path, gtfs_fetch.MANIFEST)) as manifest_file:
+            feeds = json.load(manifest_file)['feeds']
+        self.assertTrue(feeds['GRT']['changed'])
+        self.assertFalse(feeds['HSR']['changed'])
+        # the previous snapshot is left as it was
+        self.assertEqual(self.read_snapshot_file(previous_snapshot_path, 'GRT.zip'), b'grt feed')
+
+
+if __name__ == '__main__':
+    unittest.main()
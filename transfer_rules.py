@@ -0,0 +1,88 @@
+import csv
+import os
+import numpy as np
+
+from clocktime import clocktime_to_seconds
+
+
+# Transfer rules of TransferRules.csv in the input_path, overriding the transfer windows
+# of config.json for some stations, agencies or routes, e.g. a longer walk from a
+# far-side bus loop, or a shorter same-platform transfer:
+#   station,agency,route,min_inbound_minutes,max_inbound_minutes,min_outbound_minutes,max_outbound_minutes,peak_split_time
+#   Bramalea GO,,,8,20,8,20,
+#   Bramalea GO,Brampton Transit,11,2,10,,,
+#   ,grt,,,,,,13:00
+# A blank station, agency or route matches any. Each setting of a local trip is taken
+# from the most specific rule matching the trip that sets it, or from config.json if none
+# does. The most specific rule is the one with the most of station, agency and route set;
+# between rules setting as many, one setting the route wins over one setting the agency,
+# which wins over one setting the station, and the later row between equally specific
+# rules. E.g. a Brampton Transit route 11 rule wins over a Bramalea GO Brampton Transit
+# rule, which wins over a Bramalea GO rule. agency and route are as in the Agency and
+# Route columns of the workbook, and peak_split_time is the hh:mm splitting the morning
+# and afternoon peaks (12:00 if unset).
+
+RULE_KEYS = ['station', 'agency', 'route']
+WINDOW_SETTINGS = [
+    'min_inbound_minutes',
+    'max_inbound_minutes',
+    'min_outbound_minutes',
+    'max_outbound_minutes',
+]
+RULE_SETTINGS = WINDOW_SETTINGS + ['peak_split_time']
+
+
+def read_transfer_rules(input_path):
+    """Returns the rules of TransferRules.csv as dicts, with None for blank fields and
+    peak_split_time in seconds. No rules if the file doesn't exist."""
+    path = input_path + '/TransferRules.csv'
+    if not os.path.exists(path):
+        return []
+    rules = []
+    with open(path, encoding='utf-8-sig') as rules_csv:
+        for row in csv.DictReader(rules_csv):
+            values = {column: (row.get(column) or '').strip() or None for column in RULE_KEYS + RULE_SETTINGS}
+            rule = {key: values[key] for key in RULE_KEYS}
+            for setting in WINDOW_SETTINGS:
+                rule[setting] = None if values[setting] is None else float(values[setting])
+            rule['peak_split_time'] = None
+            if values['peak_split_time'] is not None:
+                rule['peak_split_time'] = clocktime_to_seconds(values['peak_split_time'])
+            rules.append(rule)
+    return rules
+
+
+def get_station_transfer_rules(transfer_rules, station_name):
+    """Returns the rules that apply at the station"""
+    return [rule for rule in transfer_rules if rule['station'] in (None, station_name)]
+
+
+def rule_specificity(rule):
+    """Returns the sort key of the rule, more specific rules sorting last"""
+    is_set = [rule[key] is not None for key in RULE_KEYS]
+    # ties are broken by route, then agency, then station
+    return (sum(is_set),) + tuple(reversed(is_set))
+
+
+def get_transfer_settings(nearby_stop_times_df, transfer_rules, defaults):
+    """Returns dict of setting -> array of the setting of each stop time, given the rules
+    of the station and the defaults (dict of setting -> value) for unset settings"""
+    settings = {
+        setting: np.full(len(nearby_stop_times_df), defaults[setting], dtype=float)
+        for setting in RULE_SETTINGS
+    }
+    if len(transfer_rules) == 0:
+        return settings
+    agencies = nearby_stop_times_df['agency'].astype(str).str.strip().to_numpy()
+    routes = nearby_stop_times_df['route_short_name'].astype(str).str.strip().to_numpy()
+    # more specific rules are applied last, the sort keeps the file order of equal ones
+    for rule in sorted(transfer_rules, key=rule_specificity):
+        matches = np.ones(len(nearby_stop_times_df), dtype=bool)
+        if rule['agency'] is not None:
+            matches &= agencies == rule['agency']
+        if rule['route'] is not None:
+            matches &= routes == rule['route']
+        for setting in RULE_SETTINGS:
+            if rule[setting] is not None:
+                settings[setting][matches] = rule[setting]
+    return settings
@@ -1,15 +1,34 @@
 import csv
 import json
 import numpy as np
-import partridge as ptg
 import pandas as pd
-import numpy as np
 import os
-import xlsxwriter
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from clocktime import seconds_to_clocktimes
+from connection_classifier import NOON, classify_connections
+from feed_cache import feed_cache_key, load_frames, save_frames
+from feed_keys import encode_keys, join_by_key, keep_keyed_rows
+from feed_normalize import get_anomalies_df, normalize_stop_times
+from feed_store import load_store, save_store
+from instrumentation import recorder
+from spatial_index import StopIndex
+from stop_time_index import StopTimeIndex
+from stop_times_stream import stream_stop_times
+from transfer_rules import get_station_transfer_rules, get_transfer_settings, read_transfer_rules
+from trip_sequences import TripStopSequences
 
 
 # This script gets all MSP arrivals and departures that occur near a GO station, organized by Stop ID.
+#
+# It can also be imported as a library: Network.load parses the feeds once, and the
+# network answers any number of connections queries afterwards:
+#   network = Network.load(date_strs=['2020-03-05'], cache_path='cache')
+#   network.select_service_date('2020-03-05')
+#   connections_df = network.connections('Bramalea GO', ['BR'], ...)
+# partridge and xlsxwriter are only imported when feeds are parsed or workbooks written.
 
 inpaths = [
     'GO',
@@ -27,46 +46,93 @@ inpaths = [
     'Niagara Falls Transit',
     'Oakville Transit',
 ]
+# directory with the {inpath}.zip GTFS files, the latest snapshot of gtfs_fetch.py
+gtfs_directory = 'gtfs_snapshots/latest'
+
+def confirm_skip_agency():
+    input((
+        'You can skip this agency if you are sure they provide '
+        'no service on the given date, press ENTER to continue, '
+        'or press CTRL-C to quit.'
+    ))
 
-def get_feed_df(inpath, _date=None):
-    """Gets the feed from the given GTFS and optional date, if the date is not
-    given then the busiest day in the GTFS feed is used.
-    Returns the GTFS loaded in a dataframe, or None if there is no
-    service on the given date"""
+def get_feed_df(inpath, dates=None, missing_service='prompt', config=None):
+    """Gets the feed from the given GTFS with the trips of every one of the given dates, if
+    no dates are given then the busiest day in the GTFS feed is used.
+    Returns the GTFS loaded in a dataframe along with the service_ids of each date (keyed
+    by date, or by 'busiest'), or None if there is no service on any of the dates.
+
+    missing_service decides what happens when there is no service on a date:
+    'prompt' asks whether to skip the agency on that date, 'skip' skips it, and 'error' raises.
+    config is an optional partridge config graph"""
+    import partridge as ptg
     print(inpath)
-    if _date is None:
+    if dates is None:
         _date, service_ids = ptg.read_busiest_date(inpath)
-    service_ids_by_date = ptg.read_service_ids_by_date(inpath)
-    service_ids = service_ids_by_date.get(_date)
-    if service_ids is None:
-        print('No service found for', inpath, 'on', _date)
-        print((
-            'Ensure that the GTFS in the gtfs directory includes the provided date, '
-            'and that the agency operates service on the provided date.'
-        ))
-        input((
-            'You can skip this agency if you are sure they provide '
-            'no service on the given date, press ENTER to continue, '
-            'or press CTRL-C to quit.'
-        ))
-        return None
-    print("Selected date for", inpath, ":", _date)
+        print("Selected date for", inpath, ":", _date)
+        service_ids_by_date = {'busiest': service_ids}
+    else:
+        # read once for all of the dates
+        feed_service_ids_by_date = ptg.read_service_ids_by_date(inpath)
+        service_ids_by_date = {}
+        missing_dates = []
+        for _date in dates:
+            service_ids = feed_service_ids_by_date.get(_date)
+            if service_ids is None:
+                missing_dates.append(_date)
+            else:
+                service_ids_by_date[_date.isoformat()] = service_ids
+        if len(missing_dates) > 0:
+            print('No service found for', inpath, 'on', ', '.join(map(str, missing_dates)))
+            if missing_service == 'error':
+                raise ValueError('No service found for {} on {}'.format(
+                    inpath,
+                    ', '.join(map(str, missing_dates)),
+                ))
+            print((
+                'Ensure that the GTFS in the gtfs directory includes the provided dates, '
+                'and that the agency operates service on the provided dates.'
+            ))
+            if missing_service == 'prompt':
+                confirm_skip_agency()
+        if len(service_ids_by_date) == 0:
+            return None
+        print("Selected dates for", inpath, ":", ', '.join(service_ids_by_date))
     # assume it'll be a typical weekday; GO rail is the same every weekday
     view = {
-        'trips.txt': {'service_id': service_ids},
+        'trips.txt': {'service_id': frozenset().union(*service_ids_by_date.values())},
     }
-    feed = ptg.load_feed(inpath, view)
-    return feed
+    feed = ptg.load_feed(inpath, view, config)
+    return feed, service_ids_by_date
+
+def get_service_dates_df(service_ids_by_date, agency):
+    """Returns a row of agency, service_id and date for each service running on each date"""
+    return pd.DataFrame(
+        [
+            (agency, service_id, date_str)
+            for date_str, service_ids in service_ids_by_date.items()
+            for service_id in sorted(service_ids)
+        ],
+        columns=['agency', 'service_id', 'date'],
+    )
+
+def get_stream_config():
+    """partridge config that doesn't prune stops by their stop times, so that stops.txt
+    can be read without reading all of stop_times.txt"""
+    import partridge as ptg
+    config = ptg.config.default_config()
+    config.remove_edge('stops.txt', 'stop_times.txt')
+    return config
+
+def load_agency_stops(zip_path):
+    import partridge as ptg
+    feed_df = ptg.load_feed(zip_path, config=get_stream_config())
+    return add_agency_col(feed_df.stops, get_agency_short_name(feed_df), ['stop_id'])
 
 def add_agency_col(df, agency, id_fields):
     df['agency'] = agency
     return df
 
-def fill_in_stop_times(df):
-    # Barrie Transit doesn't put in arrival/departure times for untimed points, so
-    # simply copy the timing point one forward
-    return df.fillna(method='ffill') # forward-fill
-
 def get_agency_short_name(feed_df):
     agency_short_name = ''
     if 'agency_id' in feed_df.agency:
@@ -75,78 +141,272 @@ def get_agency_short_name(feed_df):
         agency_short_name = feed_df.agency.agency_name.head(1).item()
     return agency_short_name
 
-def initialize_feeds(date_str=None):
-    _date = None
-    if date_str is not None:
-        _date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
-    feed_dfs = []
-    for inpath in inpaths:
-        feed_df = get_feed_df('gtfs/'+inpath+'.zip', _date)
-        if feed_df is not None:
-            feed_dfs.append(feed_df)
-    global stops_df
-    stops_df = pd.concat([
-        add_agency_col(
-            feed_df.stops,
-            get_agency_short_name(feed_df),
-            ['stop_id'],
-        ) for feed_df in feed_dfs
-    ], ignore_index=True, join='inner')
-    global trips_df
-    trips_df = pd.concat(
-        [add_agency_col(
-            feed_df.trips,
-            get_agency_short_name(feed_df),
-            ['trip_id', 'route_id'],
-        ) for feed_df in feed_dfs],
-        ignore_index=True,
-        join='inner',
+def load_agency_frames(
+    zip_path,
+    dates=None,
+    missing_service='prompt',
+    nearby_stop_ids=None,
+    cache_path=None,
+):
+    """Loads and normalizes a single agency's GTFS for the given dates (the busiest date
+    if None). Returns a dict of its stops, trips, stop_times, routes, service_dates and
+    anomalies dataframes, or None if there is no service on any of the given dates.
+    The frames are kept in cache_path until the GTFS zip changes.
+
+    If nearby_stop_ids is given, stop_times.txt is streamed and only the stop times at
+    those stops are kept, along with the stop count of each trip"""
+    if cache_path is not None:
+        cache_key = feed_cache_key(
+            [zip_path],
+            None if dates is None else ','.join(_date.isoformat() for _date in dates),
+            {'agency_frames': True, 'nearby_stop_ids': nearby_stop_ids},
+        )
+        frames = load_frames(cache_path, cache_key)
+        if frames is not None:
+            print('Loaded', zip_path, 'from cache', cache_key)
+            return frames
+    loaded_feed = get_feed_df(
+        zip_path,
+        dates,
+        missing_service,
+        None if nearby_stop_ids is None else get_stream_config(),
     )
-    trips_df.set_index(['agency', 'trip_id'], inplace=True)
-    global stop_times_df
-    stop_times_df = pd.concat(
-        [fill_in_stop_times(add_agency_col(
-            feed_df.stop_times,
-            get_agency_short_name(feed_df),
-            ['stop_id', 'trip_id'],
-        )) for feed_df in feed_dfs],
-        ignore_index=True,
-        join='inner',
+    if loaded_feed is None:
+        return None
+    feed_df, service_ids_by_date = loaded_feed
+    agency = get_agency_short_name(feed_df)
+    stops_df = add_agency_col(feed_df.stops, agency, ['stop_id'])
+    trips_df = add_agency_col(feed_df.trips, agency, ['trip_id', 'route_id'])
+    if nearby_stop_ids is None:
+        stop_times_df, anomalies = normalize_stop_times(feed_df.stop_times)
+    else:
+        stop_times_df, trip_stop_counts, anomalies = stream_stop_times(
+            zip_path,
+            trips_df['trip_id'],
+            nearby_stop_ids,
+        )
+    stop_times_df = add_agency_col(stop_times_df, agency, ['stop_id', 'trip_id'])
+    anomalies_df = get_anomalies_df(anomalies, agency)
+    if len(anomalies_df) > 0:
+        print('Anomalies in', zip_path, ':', ', '.join(
+            '{} {}'.format(count, anomaly)
+            for anomaly, count in zip(anomalies_df['anomaly'], anomalies_df['count'])
+        ))
+
+    if nearby_stop_ids is not None:
+        trips_df = trips_df.merge(
+            trip_stop_counts.rename('trip_stop_count'),
+            left_on='trip_id',
+            right_index=True,
+            validate='one_to_one',
+        )
+
+    routes_df = add_agency_col(feed_df.routes, agency, ['route_id'])
+    frames = {
+        'stops': stops_df,
+        'trips': trips_df,
+        'stop_times': stop_times_df,
+        'routes': routes_df,
+        'service_dates': get_service_dates_df(service_ids_by_date, agency),
+        'anomalies': anomalies_df,
+    }
+    if cache_path is not None:
+        save_frames(cache_path, cache_key, frames)
+    return frames
+
+def record_agency_frames(
+    zip_path,
+    dates=None,
+    missing_service='prompt',
+    nearby_stop_ids=None,
+    cache_path=None,
+):
+    """load_agency_frames as a recorded stage, returns the frames along with the stage's
+    records so that workers can send them back to the main process"""
+    first_record = len(recorder.records)
+    with recorder.stage('load_agency_frames', agency=zip_path) as record:
+        frames = load_agency_frames(zip_path, dates, missing_service, nearby_stop_ids, cache_path)
+        if frames is not None:
+            record['rows_out'] = len(frames['stop_times'])
+    return frames, recorder.records[first_record:]
+
+def load_feeds(
+    zip_paths,
+    dates=None,
+    workers=1,
+    missing_service='prompt',
+    nearby_stop_ids=None,
+    cache_path=None,
+):
+    """Loads the GTFS zips for the given dates and combines them into the stops, trips,
+    stop_times, routes, service_dates and anomalies dataframes, returned as a dict along
+    with the frames of the trip stop sequences when the stop times are fully loaded.
+    nearby_stop_ids is an optional list with the stop_ids to stream for each zip, and
+    cache_path keeps each agency's normalized frames until its zip changes.
+
+    With more than one worker each agency is loaded in its own process. Workers never
+    prompt, agencies without service are only confirmed once all feeds are loaded."""
+    is_streamed = nearby_stop_ids is not None
+    if not is_streamed:
+        nearby_stop_ids = [None] * len(zip_paths)
+    if workers > 1:
+        worker_missing_service = 'skip' if missing_service == 'prompt' else missing_service
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            agency_frames = []
+            for frames, records in executor.map(
+                record_agency_frames,
+                zip_paths,
+                repeat(dates),
+                repeat(worker_missing_service),
+                nearby_stop_ids,
+                repeat(cache_path),
+            ):
+                agency_frames.append(frames)
+                recorder.records.extend(records)
+        if missing_service == 'prompt' and dates is not None:
+            date_strs = [_date.isoformat() for _date in dates]
+            for zip_path, frames in zip(zip_paths, agency_frames):
+                service_date_strs = set() if frames is None else set(frames['service_dates']['date'])
+                missing_date_strs = [
+                    date_str for date_str in date_strs if date_str not in service_date_strs
+                ]
+                if len(missing_date_strs) > 0:
+                    print('No service found for', zip_path, 'on', ', '.join(missing_date_strs))
+                    confirm_skip_agency()
+    else:
+        agency_frames = [
+            record_agency_frames(zip_path, dates, missing_service, agency_nearby_stop_ids, cache_path)[0]
+            for zip_path, agency_nearby_stop_ids in zip(zip_paths, nearby_stop_ids)
+        ]
+    agency_frames = [frames for frames in agency_frames if frames is not None]
+
+    def concat_frames(name):
+        return pd.concat(
+            [frames[name] for frames in agency_frames],
+            ignore_index=True,
+            join='inner',
+        )
+    stops_df = concat_frames('stops')
+    trips_df = concat_frames('trips')
+    stop_times_df = concat_frames('stop_times')
+    routes_df = concat_frames('routes')
+    service_dates_df = concat_frames('service_dates')
+    anomalies_df = concat_frames('anomalies')
+
+    # intern the agency qualified ids as int32 keys (the row position of each stop, trip
+    # and route) so that all joins and groupbys are on integers
+    stop_times_df['stop_key'] = encode_keys(stops_df, stop_times_df, ['agency', 'stop_id'])
+    stop_times_df['trip_key'] = encode_keys(trips_df, stop_times_df, ['agency', 'trip_id'])
+    # stop times of trips not in trips.txt would take the last trip's key (-1) below
+    is_unknown_trip = stop_times_df['trip_key'] < 0
+    if is_unknown_trip.any():
+        unknown_trip_counts = stop_times_df.loc[is_unknown_trip, 'agency'].value_counts()
+        unknown_trip_counts = unknown_trip_counts[unknown_trip_counts > 0]
+        print('Stop times of unknown trips, dropped:', ', '.join(
+            '{} {}'.format(count, agency) for agency, count in unknown_trip_counts.items()
+        ))
+        anomalies_df = pd.concat([anomalies_df, pd.DataFrame({
+            'agency': unknown_trip_counts.index,
+            'anomaly': 'unknown_trip_stop_times',
+            'count': unknown_trip_counts.to_numpy(),
+        })], ignore_index=True)
+    stop_times_df = stop_times_df[(stop_times_df['stop_key'] >= 0) & ~is_unknown_trip].drop(
+        columns=['agency', 'stop_id', 'trip_id'],
     )
-    stop_times_df.set_index(['agency', 'stop_id'], inplace=True)
-
-    # convert times to readable format
-    def seconds_to_clocktime(time):
-        # TTC GTFS has seconds for some reason - round down to the minute, also done in
-        # the has_connection function
-        return format(int(time // 3600), '02') + ':' + format(int((time % 3600) // 60), '02')
-    stop_times_df['arrival_time_hhmm'] = stop_times_df['arrival_time'].apply(seconds_to_clocktime)
-    stop_times_df['departure_time_hhmm'] = stop_times_df['departure_time'].apply(seconds_to_clocktime)
-
-    # add stops list ({stop_code};dep_time,...), needed by catviz
-    trips_df = stop_times_df.reset_index().groupby(['agency', 'trip_id']).agg({
-        'stop_id': lambda stop_id : tuple(stop_id),
-        'departure_time_hhmm': lambda stop_dep_time : tuple(stop_dep_time), 
-    }).merge(trips_df, left_index=True, right_index=True, validate='one_to_one').rename(columns={
-        'stop_id': 'trip_stops',
-        'departure_time_hhmm': 'trip_stop_departure_times',
+    trips_df['route_key'] = encode_keys(routes_df, trips_df, ['agency', 'route_id'])
+    if not is_streamed:
+        trips_df['trip_stop_count'] = np.bincount(
+            stop_times_df['trip_key'],
+            minlength=len(trips_df),
+        )
+    # only keep trips having stop times and a route
+    trips_df, stop_times_df['trip_key'] = keep_keyed_rows(
+        trips_df,
+        (trips_df['trip_stop_count'] > 0) & (trips_df['route_key'] >= 0),
+        stop_times_df['trip_key'],
+    )
+    stop_times_df = stop_times_df[stop_times_df['trip_key'] >= 0].reset_index(drop=True)
+
+    frames = {}
+    if not is_streamed:
+        # add stops list ({stop_code};dep_time,...), needed by catviz
+        trip_sequences = TripStopSequences.from_stop_times(
+            stop_times_df['trip_key'],
+            stop_times_df['stop_key'],
+            stop_times_df['departure_time'],
+            len(trips_df),
+            stops_df['stop_id'],
+        )
+        frames.update(trip_sequences.to_frames())
+    frames.update({
+        'stops': stops_df,
+        'trips': trips_df,
+        'stop_times': stop_times_df,
+        'routes': routes_df,
+        'service_dates': service_dates_df,
+        'anomalies': anomalies_df,
     })
+    return frames
 
-    global routes_df
-    routes_df = pd.concat([
-        add_agency_col(
-            feed_df.routes,
-            get_agency_short_name(feed_df),
-            ['route_id'],
-        ) for feed_df in feed_dfs],
-        ignore_index=True,
-        join='inner',
+def get_stream_stop_ids(zip_paths, stream_stations, location_overrides, connection_max_distance):
+    """Loads the stops of every feed, and returns the stop_ids near any of the given
+    stations for each zip"""
+    agency_stops_dfs = [load_agency_stops(zip_path) for zip_path in zip_paths]
+    stops_df = pd.concat(agency_stops_dfs, ignore_index=True, join='inner')
+    stops_index = StopIndex(stops_df['stop_lat'], stops_df['stop_lon'])
+    nearby_stop_keys = set()
+    for station_name in stream_stations:
+        station_stops = get_station_stops(
+            stops_df,
+            station_name,
+            location_overrides.get(station_name, []),
+        )
+        if len(station_stops) > 0:
+            nearby_stop_keys.update(get_nearby_stops(
+                stops_df,
+                stops_index,
+                station_name,
+                station_stops,
+                connection_max_distance,
+            ).index)
+    nearby_stops_df = stops_df.take(sorted(nearby_stop_keys))
+    return [
+        list(nearby_stops_df.loc[nearby_stops_df['agency'].isin(agency_stops_df['agency']), 'stop_id'])
+        for agency_stops_df in agency_stops_dfs
+    ]
+
+def get_zip_paths(directory=None):
+    """Returns the GTFS zip of each of the inpaths, in directory (gtfs_directory if None)"""
+    return [os.path.join(directory or gtfs_directory, inpath+'.zip') for inpath in inpaths]
+
+
+def get_feeds_key(
+    date_strs=None,
+    stream_stations=None,
+    location_overrides=None,
+    connection_max_distance=None,
+    directory=None,
+):
+    """Returns the feed cache key of the network loaded by Network.load with the same
+    arguments"""
+    if location_overrides is None:
+        location_overrides = {}
+    stream_options = None
+    if stream_stations is not None:
+        stream_options = {
+            'stations': sorted(stream_stations),
+            'location_overrides': {
+                station_name: location_overrides[station_name]
+                for station_name in sorted(stream_stations)
+                if station_name in location_overrides
+            },
+            'connection_max_distance': connection_max_distance,
+        }
+    return feed_cache_key(
+        get_zip_paths(directory),
+        None if date_strs is None else ','.join(date_strs),
+        stream_options,
     )
-    routes_df.set_index(['agency', 'route_id'], inplace=True)
-    print(stops_df.head())
-    print(trips_df.head())
-    print(stop_times_df.head())
-    print(routes_df.head())
 
 
 # returns map of station -> list of values
@@ -171,403 +431,922 @@ def read_config():
     with open('./config.json') as config_file:
         return json.load(config_file)
 
-def haversine(lat1, lon1, lat2, lon2):
-    MILES = 3959
-    lat1, lon1, lat2, lon2 = map(np.deg2rad, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1 
-    dlon = lon2 - lon1 
-    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
-    c = 2 * np.arcsin(np.sqrt(a)) 
-    total_miles = MILES * c
-    return total_miles * 1.6 * 1000 # return metres
+
+def read_config_dates(input_dict):
+    """Returns the list of date strings to analyze: the dates list, every date of the
+    inclusive [start, end] date_range, or the single date. None means the busiest date."""
+    if input_dict.get('dates'):
+        return input_dict['dates']
+    if input_dict.get('date_range'):
+        start, end = [
+            datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
+            for date_str in input_dict['date_range']
+        ]
+        return [
+            (start + datetime.timedelta(days=days)).isoformat()
+            for days in range((end - start).days + 1)
+        ]
+    if input_dict.get('date'):
+        return [input_dict['date']]
+    return None
 
 # now turn it into the readable format with inbound/outbound/both fields
 # result also used as a unique ID for arrivals returned
-def get_stop_time_route_stop(row):
-    trip_name = str(row['trip_headsign']) or str(row['trip_short_name'])
-    # always needed for new rows format
-    route_id = str(row['route_short_name']) # + ' ' if str(row['route_short_name']) not in trip_name else ''
-    # token inserted as to properly split when outputting
-    return str(row['agency']) + ' &gtfstoken& ' + str(route_id) + ' &gtfstoken& '  + trip_name + ' at ' + str(row['stop_name'])
-
-# returns hour (hh:00) of time string (hh:mm)
-# used in-place of corridor to more easily view and compare trips on an hour-by-hour basis
-def get_hour_of_time(time_hhmm):
-    return time_hhmm[:2] + ':00'
-
-# whether a stop arrival belongs to a Corridor route
-def is_corridor_stop_time(stop_time, station_stops, corridor_route_ids):
-    contains_stop = False
-    for station_stop in station_stops.itertuples(index=False):
-        if station_stop.stop_id == stop_time['stop_id']:
-            contains_stop = True
-            break
-    route_id = str(stop_time['route_short_name'])
-    if contains_stop and route_id in corridor_route_ids:
-        return True
-    return False
+def get_stop_time_directions(nearby_stop_times_df):
+    """Returns the headsign of each stop time's trip, or its trip_short_name where the
+    headsign is empty"""
+    headsigns = nearby_stop_times_df['trip_headsign'].astype(str)
+    if 'trip_short_name' not in nearby_stop_times_df.columns:
+        return headsigns
+    return headsigns.where(headsigns != '', nearby_stop_times_df['trip_short_name'].astype(str))
+
+# whether each stop arrival belongs to a Corridor route
+def get_corridor_stop_times(nearby_stop_times_df, station_stops, corridor_route_ids):
+    """Returns whether each stop time is at one of the station's stops (same agency and
+    stop_id) on one of the corridor routes, as a boolean array"""
+    is_station_stop = pd.MultiIndex.from_frame(nearby_stop_times_df[['agency', 'stop_id']]).isin(
+        pd.MultiIndex.from_frame(station_stops[['agency', 'stop_id']]),
+    )
+    is_corridor_route = nearby_stop_times_df['route_short_name'].astype(str).isin(corridor_route_ids)
+    return is_station_stop & is_corridor_route.to_numpy()
 
 
 def get_stop_time_meeting_types(
     nearby_stop_times_df,
-    station_stops,
-    corridor_route_ids,
     min_inbound_minutes,
     max_inbound_minutes,
     min_outbound_minutes,
     max_outbound_minutes,
     hourly_summary,
     union_station_is_inbound=False,
+    transfer_rules=(),
 ):
     """Using the supplied inbound/outbound transfer limits, determines whether each transit trip
     corresponds to a Corridor trip, an Inbound connection (to a corridor), an Outbound connection
     (from a corridor), Both, or None.
 
-    If union_station_is_inbound is set to true, then the connection type has a second section,
-    the addition of -{connection_type} for inbound corridor trips only.
+    Also determines the peak connection type, the connection type when only counting corridor
+    trips to Union Station in the morning and from Union Station in the afternoon.
 
-    Returns connection_type, with -peak_connection_type appended if it is not None
+    The limits and the peak split time of each trip are those of the most specific of the
+    station's transfer_rules matching it (see transfer_rules.py), or the given ones.
+
+    The corridor trips are the stop times with is_corridor set (see get_corridor_stop_times).
+    Returns the stop times with connection_type and peak_connection_type columns, the
+    number of inbound/outbound connections and the minimum wait in minutes of each, and
+    the peak_split_time used
     """
-    corridor_arrival_by_direction = {}
-    def set_corridors(row):
-        """Populates corridor_arrival_by_direction and sets the connection type to
-        corridor if applicable"""
-        if is_corridor_stop_time(row, station_stops, corridor_route_ids): 
-            corridor_arrival_time = row['arrival_time']
-            corridor_direction = row['trip_headsign']
-            if corridor_direction not in corridor_arrival_by_direction:
-                corridor_arrival_by_direction[corridor_direction] = []
-            corridor_arrival_by_direction[corridor_direction].append(corridor_arrival_time)
-            if hourly_summary:
-                row[get_stop_time_route_stop(row)] = get_hour_of_time(row['arrival_time_hhmm'])
-                return row
-            row[get_stop_time_route_stop(row)] = 'Corridor'
-        return row
-
-    def set_meeting_type(row):
-        if row.get(get_stop_time_route_stop(row)) == 'Corridor':
-            return row
-
-        # Skip Inbound if stop is the trip's first (ie. departing at the bus loop)
-        skip_inbound = False
-        if row['stop_sequence'] == 1:
-            skip_inbound = True
-        # Skip Outbound if the stop is the trip's last (ie. arriving at the bus loop)
-        skip_outbound = False
-        if row['stop_sequence'] == len(row['trip_stops']):
-            skip_outbound = True
-
-        nonlocal corridor_arrival_by_direction
-
-        def has_connection(arrival_time, is_outbound, union_station_is_inbound=False):
-            """Given the arrival time of a local route, verifies whether it has an inbound
-            or outbound (based on argument) connection to the corridor, comparing only to inbound
-            corridor arrivals if union_station_is_inbound is set to true."""
-            for corridor_direction in corridor_arrival_by_direction:
-                if union_station_is_inbound and 'Union Station' not in corridor_direction and arrival_time < 60*60*12: # 12:00
-                    continue
-                if union_station_is_inbound and 'Union Station' in corridor_direction and arrival_time >= 60*60*12:
-                    continue
-                for corridor_arrival in corridor_arrival_by_direction[corridor_direction]:
-                    outbound_transfer = (arrival_time // 60) - (corridor_arrival // 60)
-                    inbound_transfer = (corridor_arrival // 60) - (arrival_time // 60)
-                    if is_outbound and outbound_transfer <= max_outbound_minutes and outbound_transfer >= min_outbound_minutes:
-                        return True
-                    if not is_outbound and inbound_transfer <= max_inbound_minutes and inbound_transfer >= min_inbound_minutes:
-                        return True
-            return False
-
-        connection_type = 'None'
-        departure_time = row['departure_time']
-        if not skip_inbound and has_connection(departure_time, False):
-            connection_type = 'Inbound'
-        if not skip_outbound and has_connection(departure_time, True):
-            connection_type = 'Both' if connection_type == 'Inbound' else 'Outbound'
-
-        peak_connection_type = None
-        if not skip_inbound and has_connection(departure_time, False, True):
-            peak_connection_type = 'Inbound'
-        if not skip_outbound and has_connection(departure_time, True, True):
-            peak_connection_type = 'Both' if peak_connection_type == 'Inbound' else 'Outbound'
-
-        peak_connection_type = f'-{peak_connection_type}' if peak_connection_type is not None else ''
-        row[get_stop_time_route_stop(row)] = connection_type + peak_connection_type
-        return row
-
-    nearby_stop_times_df = nearby_stop_times_df.apply(
-        set_corridors,
-        axis=1,
+    if nearby_stop_times_df.empty:
+        return nearby_stop_times_df.assign(
+            connection_type=pd.Series(dtype=object),
+            peak_connection_type=pd.Series(dtype=object),
+            inbound_connections=pd.Series(dtype=np.int64),
+            outbound_connections=pd.Series(dtype=np.int64),
+            min_inbound_wait=pd.Series(dtype=float),
+            min_outbound_wait=pd.Series(dtype=float),
+            peak_split_time=pd.Series(dtype=float),
+        )
+    is_corridor = nearby_stop_times_df['is_corridor'].to_numpy(dtype=bool)
+    corridor_stop_times_df = nearby_stop_times_df[is_corridor]
+
+    # Skip Inbound if stop is the trip's first (ie. departing at the bus loop)
+    skip_inbound = nearby_stop_times_df['stop_sequence'] == 1
+    # Skip Outbound if the stop is the trip's last (ie. arriving at the bus loop)
+    skip_outbound = nearby_stop_times_df['stop_sequence'] == nearby_stop_times_df['trip_stop_count']
+
+    settings = get_transfer_settings(nearby_stop_times_df, transfer_rules, {
+        'min_inbound_minutes': min_inbound_minutes,
+        'max_inbound_minutes': max_inbound_minutes,
+        'min_outbound_minutes': min_outbound_minutes,
+        'max_outbound_minutes': max_outbound_minutes,
+        'peak_split_time': NOON,
+    })
+    connection_types, peak_connection_types, connections = classify_connections(
+        nearby_stop_times_df['departure_time'],
+        skip_inbound,
+        skip_outbound,
+        corridor_stop_times_df['arrival_time'],
+        corridor_stop_times_df['trip_headsign'],
+        settings['min_inbound_minutes'],
+        settings['max_inbound_minutes'],
+        settings['min_outbound_minutes'],
+        settings['max_outbound_minutes'],
+        settings['peak_split_time'],
     )
-    return nearby_stop_times_df.apply(
-        set_meeting_type,
-        axis=1,
+    # with hourly_summary the corridor trips are classified like any other trip
+    if not hourly_summary:
+        connection_types[is_corridor] = 'Corridor'
+        peak_connection_types[is_corridor] = 'None'
+        for column in ['inbound_connections', 'outbound_connections']:
+            connections[column][is_corridor] = 0
+        for column in ['min_inbound_wait', 'min_outbound_wait']:
+            connections[column][is_corridor] = np.nan
+    return nearby_stop_times_df.assign(
+        connection_type=connection_types,
+        peak_connection_type=peak_connection_types,
+        **connections,
+        peak_split_time=settings['peak_split_time'],
     )
 
-"""Returns dataframe of all MSP connections at the given station.
-Also writes CSV containing all MSP departures at the given station in the dev directory"""
-def get_local_msp_connections(
+def get_station_stops(stops_df, station_name, location_overrides):
+    """Returns the stops of the given station, with one copy of each stop at every
+    overridden location of the station"""
+    station_stops = stops_df.loc[stops_df['stop_name'] == station_name]
+    if len(station_stops) == 0 or len(location_overrides) == 0:
+        return station_stops
+    new_station_stops = []
+    station_stops = station_stops.to_dict(orient='records')
+    for station_stop in station_stops:
+        for location in location_overrides:
+            new_station_stop = dict(station_stop)
+            new_station_stop['stop_lat'] = float(location.split(',')[0])
+            new_station_stop['stop_lon'] = float(location.split(',')[1])
+            new_station_stops.append(new_station_stop)
+    return pd.DataFrame(new_station_stops)
+
+
+def get_nearby_stops(
+    stops_df,
+    stops_index,
     station_name,
-    corridor_route_ids,
+    station_stops,
     connection_max_distance,
+    station_distances=None,
+):
+    """Returns all stops within connection_max_distance of the station, as well as all
+    stops of the station itself, indexed by stop_key with their connection_distance.
+    stops_index is the StopIndex of stops_df. The distance is the walking distance of
+    station_distances (see walking_distance.py) if given, the straight-line one otherwise."""
+    with recorder.stage('get_nearby_stops', station=station_name) as record:
+        nearby = None
+        if station_distances is not None:
+            nearby = station_distances.nearby_stops(station_name, connection_max_distance)
+            if nearby is None:
+                print('No walking distances for', station_name, 'using straight-line distances')
+        if nearby is None:
+            nearby = stops_index.within(
+                station_stops['stop_lat'],
+                station_stops['stop_lon'],
+                connection_max_distance,
+            )
+        positions, distances = nearby
+        station_positions = np.setdiff1d(
+            np.flatnonzero((stops_df['stop_name'] == station_name).to_numpy()),
+            positions,
+        )
+        positions = np.concatenate([positions, station_positions])
+        distances = np.concatenate([distances, stops_index.distances(
+            station_positions,
+            station_stops['stop_lat'],
+            station_stops['stop_lon'],
+        )])
+        order = np.argsort(positions)
+        nearby_stops_df = stops_df.take(positions[order]).assign(
+            connection_distance=distances[order],
+        )
+        # stop keys are the row positions of stops_df
+        nearby_stops_df.index = pd.Index(positions[order], name='stop_key')
+        record['rows_out'] = len(nearby_stops_df)
+    return nearby_stops_df
+
+
+def add_trip_stops(nearby_stop_times_df, trip_sequences):
+    """Adds the stops list ({stop_code};dep_time,...) of each trip, needed by catviz"""
+    trip_keys = nearby_stop_times_df['trip_key'].tolist()
+    return nearby_stop_times_df.assign(
+        trip_stops=[trip_sequences.trip_stops(trip_key) for trip_key in trip_keys],
+        trip_stop_departure_times=[
+            trip_sequences.trip_stop_departure_times(trip_key) for trip_key in trip_keys
+        ],
+    )
+
+
+def get_station_connections(
+    station_name,
+    station_stops,
+    nearby_stop_times_df,
+    corridor_route_ids,
     min_inbound_minutes,
     max_inbound_minutes,
     min_outbound_minutes,
     max_outbound_minutes,
     only_show_corridors,
     hourly_summary,
-    location_overrides,
     union_station_is_inbound,
+    write_raw_csv=False,
+    transfer_rules=(),
+    raw_parquet_path=None,
+    trip_sequences=None,
 ):
-    station_stops = stops_df.loc[stops_df['stop_name'] == station_name]
-    if len(station_stops) == 0:
-        # station doesn't exist, return empty
-        return ([], [], station_name)
-
-    if len(location_overrides) > 0:
-        new_station_stops = []
-        station_stops = station_stops.to_dict(orient='records')
-        for station_stop in station_stops:
-            for location in location_overrides:
-                new_station_stop = dict(station_stop)
-                new_station_stop['stop_lat'] = float(location.split(',')[0])
-                new_station_stop['stop_lon'] = float(location.split(',')[1])
-                new_station_stops.append(new_station_stop)
-        station_stops = pd.DataFrame(new_station_stops)
-
-    # gets connection distance between each station and all stops
-    connections = []
-    for station_stop in station_stops.itertuples():
-       connections.append(haversine(
-           station_stop.stop_lat,
-           station_stop.stop_lon,
-           stops_df['stop_lat'],
-           stops_df['stop_lon'],
-        ))
-    stops_df['connection_distance'] = pd.concat(connections).groupby(level=0).min()
-    nearby_stops_df = stops_df[(stops_df['connection_distance'] <= connection_max_distance) | (stops_df['stop_name'] == station_name)]
-    print('Nearby Stops: ', nearby_stops_df.head())
-
-    nearby_stops_df.set_index(['agency', 'stop_id'], inplace=True)
-    nearby_stop_times_df = stop_times_df.merge(
-        nearby_stops_df,
-        left_index=True,
-        right_index=True,
-        validate='many_to_one',
-    )
-    nearby_stop_times_df.reset_index(inplace=True)
-
-    nearby_stop_times_df.set_index(['agency', 'trip_id'], inplace=True)
-    # only keep trip arrival closest to station, as one route could have
-    # multiple stops close to a GO station
-    nearby_stop_times_df = nearby_stop_times_df.sort_values(
-        by=['connection_distance'],
-    ).groupby(
-        by=['agency', 'trip_id'],
-    ).first()
-    nearby_stop_times_df = nearby_stop_times_df.merge(
-        trips_df,
-        left_index=True,
-        right_index=True,
-        validate='many_to_one',
-    )
-    nearby_stop_times_df.reset_index(inplace=True)
-
-    nearby_stop_times_df.set_index(['agency', 'route_id'], inplace=True)
-    nearby_stop_times_df = nearby_stop_times_df.merge(
-        routes_df,
-        left_index=True,
-        right_index=True,
-        validate='many_to_one',
-    )
-    nearby_stop_times_df.reset_index(inplace=True)
-    print(nearby_stop_times_df.head())
-
-    nearby_stop_times_df = nearby_stop_times_df.sort_values(['arrival_time_hhmm', 'departure_time_hhmm'])
-    print('Transit at Station:', nearby_stop_times_df)
-    # output dev file
-    nearby_stop_times_df.to_csv(
-        './output/dev/{station_name}-raw.csv'.format(
-            station_name=station_name,
-        ),
-        index=False,
-    )
-    # identify whether arrivals/departures are inbound/outbound/both/none
-    nearby_stop_times_df = get_stop_time_meeting_types(
+    """Classifies the nearby trip stop times of a station, returns its connections table.
+    write_raw_csv also writes the nearby trip stop times to the dev output directory, with
+    the stops list of each trip if the TripStopSequences of the network are given.
+    transfer_rules are the rules of read_transfer_rules, only the station's apply.
+    raw_parquet_path is the date's directory of the stop_times export (see
+    connections_export.py) to write the classified nearby trip stop times to, if any"""
+    nearby_stop_times_df = nearby_stop_times_df.sort_values(['arrival_time', 'departure_time'])
+    if write_raw_csv:
+        # output dev file, the readable times and stops lists are only built for it
+        raw_stop_times_df = nearby_stop_times_df.assign(
+            arrival_time_hhmm=seconds_to_clocktimes(nearby_stop_times_df['arrival_time']),
+            departure_time_hhmm=seconds_to_clocktimes(nearby_stop_times_df['departure_time']),
+        )
+        if trip_sequences is not None:
+            raw_stop_times_df = add_trip_stops(raw_stop_times_df, trip_sequences)
+        raw_stop_times_df.to_csv(
+            './output/dev/{station_name}-raw.csv'.format(
+                station_name=station_name,
+            ),
+            index=False,
+        )
+    # computed once, for the classification and the only_show_corridors filter
+    nearby_stop_times_df = nearby_stop_times_df.assign(is_corridor=get_corridor_stop_times(
         nearby_stop_times_df,
         station_stops,
         corridor_route_ids,
-        min_inbound_minutes,
-        max_inbound_minutes,
-        min_outbound_minutes,
-        max_outbound_minutes,
-        hourly_summary,
-        union_station_is_inbound,
-    )
+    ))
+    # identify whether arrivals/departures are inbound/outbound/both/none
+    with recorder.stage(
+        'get_stop_time_meeting_types',
+        station=station_name,
+        rows_in=len(nearby_stop_times_df),
+    ) as record:
+        nearby_stop_times_df = get_stop_time_meeting_types(
+            nearby_stop_times_df,
+            min_inbound_minutes,
+            max_inbound_minutes,
+            min_outbound_minutes,
+            max_outbound_minutes,
+            hourly_summary,
+            union_station_is_inbound,
+            get_station_transfer_rules(transfer_rules, station_name),
+        )
+        record['rows_out'] = len(nearby_stop_times_df)
+    if raw_parquet_path is not None:
+        from connections_export import export_stop_times
+        export_stop_times(nearby_stop_times_df, raw_parquet_path, station_name)
     if only_show_corridors:
-        nearby_stop_times_df = nearby_stop_times_df[nearby_stop_times_df.apply(
-            lambda row : is_corridor_stop_time(row, station_stops, corridor_route_ids),
-            axis=1,
-        )]
-    print('Matched to meeting type', nearby_stop_times_df.head())
-    try:
-        route_stops = sorted(nearby_stop_times_df[nearby_stop_times_df.apply(
-            lambda row : is_corridor_stop_time(row, station_stops, corridor_route_ids),
-            axis=1,
-        )].apply(
-            get_stop_time_route_stop,
-            axis=1,
-        ).unique())
-    except:
+        nearby_stop_times_df = nearby_stop_times_df[nearby_stop_times_df['is_corridor']]
+    if nearby_stop_times_df.empty:
         # station has no trips
-        return ([], [], station_name)
-
-    route_non_corridor_stops_df = nearby_stop_times_df[nearby_stop_times_df.apply(
-        lambda row : is_corridor_stop_time(row, station_stops, corridor_route_ids) == False,
-        axis=1,
-    )].apply(
-        get_stop_time_route_stop,
-        axis=1,
-    )
-    route_non_corridor_stops = []
-    if not route_non_corridor_stops_df.empty:
-        # unique errors on empty dataframes, which is possible for non-corridors
-        route_non_corridor_stops = sorted(route_non_corridor_stops_df.unique())
-    route_stops += route_non_corridor_stops
-    # return final file here
-    header = ['Arrival Time', 'Departure Time', *route_stops]
-    connection_dicts = nearby_stop_times_df.apply(
-        lambda row : {
-            'Arrival Time': row['arrival_time_hhmm'],
-            'Departure Time': row['departure_time_hhmm'],
-            get_stop_time_route_stop(row): row[get_stop_time_route_stop(row)] or '',
-        },
-        axis=1,
+        return empty_connections_df()
+    connections_df = pd.DataFrame({
+        'station': station_name,
+        'arrival_time': seconds_to_clocktimes(nearby_stop_times_df['arrival_time']),
+        'departure_time': seconds_to_clocktimes(nearby_stop_times_df['departure_time']),
+        'connection_type': nearby_stop_times_df['connection_type'].to_numpy(),
+        'peak_connection_type': nearby_stop_times_df['peak_connection_type'].to_numpy(),
+        'agency': nearby_stop_times_df['agency'].astype(str).str.strip().to_numpy(),
+        'route': nearby_stop_times_df['route_short_name'].astype(str).str.strip().to_numpy(),
+        'direction': get_stop_time_directions(nearby_stop_times_df).str.strip().to_numpy(),
+        'stop': nearby_stop_times_df['stop_name'].astype(str).str.strip().to_numpy(),
+        'inbound_connections': nearby_stop_times_df['inbound_connections'].to_numpy(),
+        'outbound_connections': nearby_stop_times_df['outbound_connections'].to_numpy(),
+        'min_inbound_wait': nearby_stop_times_df['min_inbound_wait'].to_numpy(),
+        'min_outbound_wait': nearby_stop_times_df['min_outbound_wait'].to_numpy(),
+    })
+    connections_df['is_peak_connection'] = get_peak_connections(
+        nearby_stop_times_df,
+        union_station_is_inbound,
+    ).to_numpy()
+    return connections_df
+
+
+# columns of the connections table produced for each station and consumed by the writers,
+# with one row per nearby trip (arrival_time and departure_time are hh:mm). The
+# connections are the number of corridor trips within the trip's transfer windows, the
+# waits the minutes to the closest of them (NaN without connections).
+CONNECTION_COLUMNS = [
+    'station',
+    'arrival_time',
+    'departure_time',
+    'connection_type',
+    'peak_connection_type',
+    'agency',
+    'route',
+    'direction',
+    'stop',
+    'inbound_connections',
+    'outbound_connections',
+    'min_inbound_wait',
+    'min_outbound_wait',
+    'is_peak_connection',
+]
+
+
+def empty_connections_df():
+    return pd.DataFrame({column: pd.Series(dtype=object) for column in CONNECTION_COLUMNS}).astype({
+        'inbound_connections': np.int64,
+        'outbound_connections': np.int64,
+        'min_inbound_wait': float,
+        'min_outbound_wait': float,
+        'is_peak_connection': bool,
+    })
+
+
+def get_peak_connections(nearby_stop_times_df, union_station_is_inbound):
+    """Whether each classified stop time is a peak connection (highlighted green), an
+    inbound connection arriving in the morning or an outbound connection departing in the
+    afternoon, split at the stop time's peak_split_time. With union_station_is_inbound,
+    the connection must also be to/from a corridor trip to/from Union Station."""
+    connection_types = nearby_stop_times_df['connection_type']
+    peak_connection_types = nearby_stop_times_df['peak_connection_type']
+    # peak_inbound is bus to station, with train to union; peak_outbound is bus from
+    # station, with train from union
+    peak_inbound = peak_connection_types.isin(['Inbound', 'Both']) | (not union_station_is_inbound)
+    peak_outbound = peak_connection_types.isin(['Outbound', 'Both']) | (not union_station_is_inbound)
+    return (
+        connection_types.isin(['Inbound', 'Both'])
+        & (nearby_stop_times_df['arrival_time'] < nearby_stop_times_df['peak_split_time'])
+        & peak_inbound
+    ) | (
+        connection_types.isin(['Outbound', 'Both'])
+        & (nearby_stop_times_df['departure_time'] >= nearby_stop_times_df['peak_split_time'])
+        & peak_outbound
     )
-    return (header, connection_dicts, station_name)
 
 
 # each column is agency, route, pattern, stop; eachrow is an arrival/departure
 # advantage is that it's much easier to filter in excel for stops with
 # many different routes
-def output_workbook(connections, union_station_is_inbound):
-    workbook = xlsxwriter.Workbook('./output/transit_connections.xlsx')
-    cell_format = workbook.add_format()
-    cell_format.set_text_wrap()
-    for (headers, connection_dicts, station_name) in connections:
-        headers = ['Arrival Time', 'Departure Time', 'Connection', 'Agency', 'Route', 'Direction', 'Stop', 'Peak Connection']
-        worksheet = workbook.add_worksheet(name=station_name)
-        worksheet.autofilter(0, 0, 0, len(headers)-1)
-        worksheet.set_column(0, 4, 15)
-        worksheet.set_column(5, 6, 60)
-        for i in range(len(headers)):
-            worksheet.write(0, i, headers[i], cell_format)
-        row = 1
-        for connection_dict in connection_dicts:
-            cell_format = workbook.add_format()
-            cell_format.set_text_wrap()
-            inbound = False
-            outbound = False
-            both = False
-            corridor = False
-            peak_inbound = False # bus to station, with train to union
-            peak_outbound = False # bus from station, with train from union
-            for connection in list(connection_dict.values()):
-                _connection = connection.split('-')[0]
-                _corridor_direction = None
-                if len(connection.split('-')) > 1:
-                    _corridor_direction = connection.split('-')[1]
-                if _connection == 'Inbound':
-                    inbound = True
-                    if _corridor_direction == 'Inbound' or _corridor_direction == 'Both':
-                        peak_inbound = True
-                if _connection == 'Outbound':
-                    outbound = True
-                    if _corridor_direction == 'Outbound' or _corridor_direction == 'Both':
-                        peak_outbound = True
-                if _connection == 'Both':
-                    both = True
-                    if _corridor_direction == 'Inbound' or _corridor_direction == 'Both':
-                        peak_inbound = True
-                    if _corridor_direction == 'Outbound' or _corridor_direction == 'Both':
-                        peak_outbound = True
-                if _connection == 'Corridor':
-                    corridor = True
-            highlight_blue = False
-            highlight_green = False
-            # highlight_green means it's a peak connection; blue means corridor connection
-            if (inbound or both) and connection_dict['Arrival Time'] < '12:00':
-                if union_station_is_inbound:
-                    if peak_inbound:
-                        highlight_green = True
-                else:
-                    highlight_green = True
-            if (outbound or both) and connection_dict['Departure Time'] >= '12:00':
-                if union_station_is_inbound:
-                    if peak_outbound:
-                        highlight_green = True
-                else:
-                    highlight_green = True
-            if corridor:
-                highlight_blue = True
-            if highlight_green:
-                cell_format.set_bg_color('#6afc9f')
-            if highlight_blue:
-                cell_format.set_bg_color('#6bd7ff')
-            for k, v in connection_dict.items():
-                if k == 'Arrival Time':
-                    worksheet.write(row, 0, v, cell_format)
-                    continue
-                if k == 'Departure Time':
-                    worksheet.write(row, 1, v, cell_format)
-                    continue
-                sections = k.split('&gtfstoken&')
-                agency = sections[0].strip()
-                route = sections[1].strip()
-                direction = sections[2].split(' at ')[0].strip()
-                stop = sections[2].split(' at ')[1].strip()
-                if corridor:
-                    worksheet.write(row, 2, 'Corridor', cell_format)
-                elif both:
-                    worksheet.write(row, 2, 'Both', cell_format) 
-                elif inbound:
-                    worksheet.write(row, 2, 'Inbound', cell_format) 
-                elif outbound:
-                    worksheet.write(row, 2, 'Outbound', cell_format)
-                else:
-                    worksheet.write(row, 2, 'None', cell_format)
-                # cannot change this ordering since CAT dashboard hardcodes column letter
-                worksheet.write(row, 3, agency, cell_format)
-                worksheet.write(row, 4, route, cell_format)
-                worksheet.write(row, 5, direction, cell_format)
-                worksheet.write(row, 6, stop, cell_format)
-                worksheet.write(row, 7, 'TRUE' if highlight_green else 'FALSE')
-            row += 1
+def output_workbook(connections_df, station_names, path='./output/transit_connections.xlsx'):
+    """Writes a sheet of connections for each station, in the given order"""
+    import xlsxwriter
+    with recorder.stage('output_workbook', rows_in=len(connections_df)):
+        # constant_memory flushes each row once written, so rows must be written in order
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        # formats are shared by all cells, green means it's a peak connection and blue means
+        # corridor connection
+        plain_format = workbook.add_format({'text_wrap': True})
+        green_format = workbook.add_format({'text_wrap': True, 'bg_color': '#6afc9f'})
+        blue_format = workbook.add_format({'text_wrap': True, 'bg_color': '#6bd7ff'})
+        headers = [
+            'Arrival Time', 'Departure Time', 'Connection', 'Agency', 'Route', 'Direction', 'Stop', 'Peak Connection',
+            'Inbound Connections', 'Outbound Connections', 'Min Inbound Wait', 'Min Outbound Wait',
+        ]
+        station_connections = {
+            station_name: station_connections_df
+            for station_name, station_connections_df in connections_df.groupby('station', sort=False)
+        }
+        for station_name in station_names:
+            worksheet = workbook.add_worksheet(name=station_name)
+            worksheet.autofilter(0, 0, 0, len(headers)-1)
+            worksheet.set_column(0, 4, 15)
+            worksheet.set_column(5, 6, 60)
+            worksheet.set_column(8, 11, 15)
+            worksheet.write_row(0, 0, headers, plain_format)
+            if station_name not in station_connections:
+                continue
+            station_connections_df = station_connections[station_name]
+            # cannot change this ordering since CAT dashboard hardcodes column letter
+            rows = zip(
+                station_connections_df['arrival_time'],
+                station_connections_df['departure_time'],
+                station_connections_df['connection_type'],
+                station_connections_df['agency'],
+                station_connections_df['route'],
+                station_connections_df['direction'],
+                station_connections_df['stop'],
+                station_connections_df['is_peak_connection'],
+            )
+            # the counts and waits follow, as the columns before them can't move
+            counts = zip(
+                station_connections_df['inbound_connections'],
+                station_connections_df['outbound_connections'],
+                # blank without connections, xlsxwriter can't write NaN
+                station_connections_df['min_inbound_wait'].astype(object).where(
+                    station_connections_df['min_inbound_wait'].notna(),
+                    None,
+                ),
+                station_connections_df['min_outbound_wait'].astype(object).where(
+                    station_connections_df['min_outbound_wait'].notna(),
+                    None,
+                ),
+            )
+            for row, ((*values, is_peak_connection), row_counts) in enumerate(zip(rows, counts), start=1):
+                cell_format = plain_format
+                if is_peak_connection:
+                    cell_format = green_format
+                if values[2] == 'Corridor':
+                    cell_format = blue_format
+                worksheet.write_row(row, 0, values, cell_format)
+                worksheet.write(row, 7, 'TRUE' if is_peak_connection else 'FALSE')
+                worksheet.write_row(row, 8, row_counts)
+        workbook.close()
+
+
+CONNECTION_TYPES = ['Corridor', 'Inbound', 'Outbound', 'Both', 'None']
+
+
+def get_connections_summary(connections_df, station_names, date_strs):
+    """Returns the number of trips of each connection type, and of peak connections, at
+    each station on each date. connections_df has the connections of every date, with a
+    date column."""
+    summary_index = pd.MultiIndex.from_product([station_names, date_strs], names=['station', 'date'])
+    summary_df = pd.crosstab(
+        [connections_df['station'], connections_df['date']],
+        connections_df['connection_type'],
+    ).reindex(index=summary_index, columns=CONNECTION_TYPES, fill_value=0)
+    summary_df.insert(0, 'Trips', summary_df.sum(axis=1))
+    summary_df['Peak Connections'] = connections_df[connections_df['is_peak_connection']].groupby(
+        ['station', 'date'],
+    ).size().reindex(summary_index, fill_value=0)
+    return summary_df.reset_index()
+
+
+def output_summary_workbook(summary_df, path='./output/transit_connections_summary.xlsx'):
+    """Writes the connection counts of each station and date to a single sheet"""
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(name='Summary')
+    headers = ['Station', 'Date', *summary_df.columns[2:]]
+    worksheet.autofilter(0, 0, 0, len(headers)-1)
+    worksheet.set_column(0, 0, 30)
+    worksheet.set_column(1, len(headers)-1, 15)
+    worksheet.write_row(0, 0, headers)
+    for row, values in enumerate(summary_df.itertuples(index=False), start=1):
+        worksheet.write_row(row, 0, values)
     workbook.close()
 
 
-input_dict = read_config()
-stations = read_stations(input_dict['input_path'])
-location_overrides = read_location_overrides(input_dict['input_path'])
-initialize_feeds(date_str=input_dict.get('date'))
-station_connections = []
-for (station_name, corridors) in stations.items():
-    if station_name != '':
-        connections = get_local_msp_connections(
-            station_name=station_name,
-            corridor_route_ids=corridors,
-            connection_max_distance=input_dict['connection_max_distance'],
-            min_inbound_minutes=input_dict['min_inbound_minutes'],
-            max_inbound_minutes=input_dict['max_inbound_minutes'],
-            min_outbound_minutes=input_dict['min_outbound_minutes'],
-            max_outbound_minutes=input_dict['max_outbound_minutes'],
-            only_show_corridors=input_dict['only_show_corridors'],
-            hourly_summary=input_dict['hourly_summary'],
-            location_overrides=location_overrides.get(station_name, []),
-            union_station_is_inbound=input_dict.get('union_station_is_inbound', False),
+
+
+class Network:
+    """The loaded feeds: the stops, trips, stop times, routes and service dates of every
+    agency, along with their indexes. The stop times of one service date at a time are
+    selected for analysis with select_service_date.
+
+    stop_key, trip_key and route_key are the row positions of stops_df, trips_df and
+    routes_df."""
+
+    def __init__(self, frames, keep_dates=False):
+        """Takes the frames returned by load_feeds. With keep_dates, the stop times of every
+        selected date are kept so that switching back to a date doesn't reindex it"""
+        self.stops_df = frames['stops']
+        self.trips_df = frames['trips']
+        self.all_stop_times_df = frames['stop_times']
+        self.routes_df = frames['routes']
+        self.service_dates_df = frames['service_dates']
+        # count of each anomaly found in each agency's stop times
+        self.anomalies_df = frames['anomalies']
+        self.trip_sequences = None
+        if 'trip_sequence_offsets' in frames:
+            self.trip_sequences = TripStopSequences.from_frames(frames, self.stops_df['stop_id'])
+        self.stops_index = StopIndex(self.stops_df['stop_lat'], self.stops_df['stop_lon'])
+        # walking distances of the stops near each station, straight-line if None
+        self.station_distances = None
+        self.keep_dates = keep_dates
+        self.date_stop_times = {}
+        self.date_str = None
+        self.stop_times_df = None
+        self.stop_time_index = None
+        print(
+            'Loaded', len(self.stops_df), 'stops,', len(self.trips_df), 'trips,',
+            len(self.all_stop_times_df), 'stop times and', len(self.routes_df), 'routes',
+        )
+
+    @classmethod
+    def load(
+        cls,
+        date_strs=None,
+        cache_path=None,
+        workers=1,
+        missing_service='prompt',
+        stream_stations=None,
+        location_overrides=None,
+        connection_max_distance=None,
+        keep_dates=False,
+        directory=None,
+    ):
+        """Loads all feeds in inpaths, with the trips of every one of the given dates (the
+        busiest date of each feed if None), compiled into a feed store in cache_path (see
+        feed_store.py) that is opened instead when none of the GTFS zips or the dates
+        changed.
+
+        If stream_stations is given, only the stop times within connection_max_distance of
+        those stations are loaded. directory holds the GTFS zips (gtfs_directory if None)"""
+        if location_overrides is None:
+            location_overrides = {}
+        dates = None
+        if date_strs is not None:
+            dates = [datetime.datetime.strptime(date_str, '%Y-%m-%d').date() for date_str in date_strs]
+        zip_paths = get_zip_paths(directory)
+        with recorder.stage('load_network') as record:
+            frames = None
+            if cache_path is not None:
+                cache_key = get_feeds_key(
+                    date_strs,
+                    stream_stations,
+                    location_overrides,
+                    connection_max_distance,
+                    directory,
+                )
+                frames = load_store(cache_path, cache_key)
+                if frames is not None:
+                    print('Opened feed store', cache_key)
+            if frames is None:
+                nearby_stop_ids = None
+                if stream_stations is not None:
+                    nearby_stop_ids = get_stream_stop_ids(
+                        zip_paths,
+                        stream_stations,
+                        location_overrides,
+                        connection_max_distance,
+                    )
+                frames = load_feeds(
+                    zip_paths,
+                    dates,
+                    workers,
+                    missing_service,
+                    nearby_stop_ids,
+                    cache_path,
+                )
+                if cache_path is not None:
+                    # the network is opened from the store, also on this first run, so
+                    # that every run has the same memory-mapped frames
+                    save_store(cache_path, cache_key, frames)
+                    frames = load_store(cache_path, cache_key)
+            record['rows_out'] = len(frames['stop_times'])
+        return cls(frames, keep_dates)
+
+    def service_dates(self):
+        """Returns the dates with service in the loaded feeds ('busiest' when the feeds
+        were loaded for their busiest dates)"""
+        return sorted(self.service_dates_df['date'].unique())
+
+    def select_service_date(self, date_str):
+        """Selects the stop times of the trips running on the date, indexed by stop and
+        departure time. The trips, stops and routes are shared by all dates"""
+        if date_str == self.date_str:
+            return
+        if date_str not in self.date_stop_times:
+            with recorder.stage('select_service_date', date=date_str) as record:
+                date_services_df = self.service_dates_df[self.service_dates_df['date'] == date_str]
+                is_running = pd.MultiIndex.from_frame(self.trips_df[['agency', 'service_id']]).isin(
+                    pd.MultiIndex.from_frame(date_services_df[['agency', 'service_id']]),
+                )
+                stop_times_df = self.all_stop_times_df[
+                    is_running[self.all_stop_times_df['trip_key'].to_numpy()]
+                ]
+                stop_time_index = StopTimeIndex.from_stop_times(stop_times_df, len(self.stops_df))
+                record['rows_out'] = len(stop_times_df)
+            print('Selected', date_str, 'with', len(stop_times_df), 'stop times')
+            self.set_date_stop_times(date_str, stop_times_df, stop_time_index)
+        self.date_str = date_str
+        self.stop_times_df, self.stop_time_index = self.date_stop_times[date_str]
+
+    def set_date_stop_times(self, date_str, stop_times_df, stop_time_index):
+        """Sets the stop times of the date and their StopTimeIndex, for select_service_date"""
+        if not self.keep_dates:
+            self.date_stop_times.clear()
+            self.date_str = None
+        self.date_stop_times[date_str] = (stop_times_df, stop_time_index)
+
+    def station_stops(self, station_name, location_overrides=None):
+        if location_overrides is None:
+            location_overrides = []
+        return get_station_stops(self.stops_df, station_name, location_overrides)
+
+    def set_station_distances(self, station_distances):
+        """Uses the walking distances of the StationDistances (see walking_distance.py) to
+        find the stops near each station, in place of straight-line distances"""
+        station_distances.set_stops(self.stops_df)
+        self.station_distances = station_distances
+
+    def nearby_stops(self, station_name, station_stops, connection_max_distance):
+        return get_nearby_stops(
+            self.stops_df,
+            self.stops_index,
+            station_name,
+            station_stops,
+            connection_max_distance,
+            self.station_distances,
         )
-        station_connections.append(connections)
-# write each connection_df as an excel sheet in a workbook having all stations
-output_workbook(
-    station_connections,
-    union_station_is_inbound=input_dict.get('union_station_is_inbound', False),
-)
+
+    def nearby_trip_stop_times(self, nearby_stop_times_df, by=()):
+        """Given stop times joined with their nearby stops, keeps only the stop time of each
+        trip closest to the station (grouped additionally by the given columns) and adds the
+        trip and route of each"""
+        with recorder.stage('get_nearby_trip_stop_times', rows_in=len(nearby_stop_times_df)) as record:
+            # only keep trip arrival closest to station, as one route could have
+            # multiple stops close to a GO station
+            nearby_stop_times_df = nearby_stop_times_df.sort_values(
+                by=['connection_distance'],
+                kind='stable',
+            ).groupby(
+                by=[*by, 'trip_key'],
+            ).first().reset_index()
+            nearby_stop_times_df = join_by_key(nearby_stop_times_df, self.trips_df, 'trip_key')
+            nearby_stop_times_df = join_by_key(nearby_stop_times_df, self.routes_df, 'route_key')
+            record['rows_out'] = len(nearby_stop_times_df)
+        return nearby_stop_times_df
+
+    def station_nearby_stop_times(self, nearby_stops_df):
+        """Returns the nearby trip stop times of a station on the selected date"""
+        return self.nearby_trip_stop_times(self.stop_times_df.take(
+            self.stop_time_index.stop_rows(nearby_stops_df.index),
+        ).merge(
+            nearby_stops_df,
+            left_on='stop_key',
+            right_index=True,
+            validate='many_to_one',
+        ))
+
+    def all_nearby_trip_stop_times(self, station_nearby_stops_dfs):
+        """Given the nearby stops of each station (station -> nearby stops), joins a single
+        station to nearby stop table to the stop times once and returns the nearby trip stop
+        times of each station on the selected date"""
+        if len(station_nearby_stops_dfs) == 0:
+            return {}
+        station_nearby_stops_df = pd.concat([
+            nearby_stops_df.assign(station=station_name)
+            for station_name, nearby_stops_df in station_nearby_stops_dfs.items()
+        ])
+        nearby_stop_times_df = self.nearby_trip_stop_times(self.stop_times_df.take(
+            self.stop_time_index.stop_rows(np.unique(station_nearby_stops_df.index)),
+        ).merge(
+            station_nearby_stops_df,
+            left_on='stop_key',
+            right_index=True,
+            validate='many_to_many',
+        ), by=['station'])
+        nearby_stop_times_by_station = {
+            station_name: station_stop_times_df.drop(columns='station')
+            for station_name, station_stop_times_df in nearby_stop_times_df.groupby('station', sort=False)
+        }
+        # stations with no stop times get an empty table
+        no_stop_times_df = nearby_stop_times_df.iloc[:0].drop(columns='station')
+        return {
+            station_name: nearby_stop_times_by_station.get(station_name, no_stop_times_df)
+            for station_name in station_nearby_stops_dfs
+        }
+
+    def connections(
+        self,
+        station_name,
+        corridor_route_ids,
+        connection_max_distance,
+        min_inbound_minutes,
+        max_inbound_minutes,
+        min_outbound_minutes,
+        max_outbound_minutes,
+        only_show_corridors,
+        hourly_summary,
+        location_overrides=None,
+        union_station_is_inbound=False,
+        write_raw_csv=False,
+        transfer_rules=(),
+        raw_parquet_path=None,
+    ):
+        """Returns the connections table of the station on the selected date.
+        write_raw_csv also writes all MSP departures at the station to the dev directory.
+        transfer_rules override the transfer windows (see transfer_rules.py), and
+        raw_parquet_path exports the classified departures (see connections_export.py)"""
+        station_stops = self.station_stops(station_name, location_overrides)
+        if len(station_stops) == 0:
+            # station doesn't exist, return empty
+            return empty_connections_df()
+        nearby_stops_df = self.nearby_stops(station_name, station_stops, connection_max_distance)
+        return get_station_connections(
+            station_name,
+            station_stops,
+            self.station_nearby_stop_times(nearby_stops_df),
+            corridor_route_ids,
+            min_inbound_minutes,
+            max_inbound_minutes,
+            min_outbound_minutes,
+            max_outbound_minutes,
+            only_show_corridors,
+            hourly_summary,
+            union_station_is_inbound,
+            write_raw_csv,
+            transfer_rules,
+            raw_parquet_path,
+            self.trip_sequences,
+        )
+
+    def all_connections(
+        self,
+        stations,
+        connection_max_distance,
+        min_inbound_minutes,
+        max_inbound_minutes,
+        min_outbound_minutes,
+        max_outbound_minutes,
+        only_show_corridors,
+        hourly_summary,
+        location_overrides=None,
+        union_station_is_inbound=False,
+        write_raw_csv=False,
+        transfer_rules=(),
+        raw_parquet_path=None,
+    ):
+        """Batch version of connections for every station in the stations map (station ->
+        corridor route ids). Builds a single station to nearby stop table, joins it to the
+        stop times once, and classifies each station's share of the result.
+        Returns the connections table of all stations."""
+        if location_overrides is None:
+            location_overrides = {}
+        station_stops_by_name = {}
+        station_nearby_stops_dfs = {}
+        for station_name in stations:
+            station_stops = self.station_stops(station_name, location_overrides.get(station_name, []))
+            if len(station_stops) == 0:
+                continue
+            station_stops_by_name[station_name] = station_stops
+            station_nearby_stops_dfs[station_name] = self.nearby_stops(
+                station_name,
+                station_stops,
+                connection_max_distance,
+            )
+
+        nearby_stop_times_by_station = self.all_nearby_trip_stop_times(station_nearby_stops_dfs)
+
+        station_connections = [empty_connections_df()]
+        for station_name, corridor_route_ids in stations.items():
+            if station_name not in station_stops_by_name:
+                # station doesn't exist, no connections
+                continue
+            station_connections.append(get_station_connections(
+                station_name,
+                station_stops_by_name[station_name],
+                nearby_stop_times_by_station[station_name],
+                corridor_route_ids,
+                min_inbound_minutes,
+                max_inbound_minutes,
+                min_outbound_minutes,
+                max_outbound_minutes,
+                only_show_corridors,
+                hourly_summary,
+                union_station_is_inbound,
+                write_raw_csv,
+                transfer_rules,
+                raw_parquet_path,
+                self.trip_sequences,
+            ))
+        return pd.concat(station_connections, ignore_index=True)
+
+    def date_connections(
+        self,
+        stations,
+        station_names,
+        location_overrides,
+        batch_stations,
+        workers=1,
+        **station_connection_args,
+    ):
+        """Returns the connections table of every station for the selected service date.
+        With more than one worker the stations are classified in parallel processes,
+        otherwise batch_stations (the batch_stations of config.json, on by default) joins
+        the stops of all the stations to the stop times at once"""
+        if workers > 1:
+            from station_executor import get_parallel_connections
+            return get_parallel_connections(
+                self,
+                stations,
+                station_names,
+                location_overrides,
+                workers,
+                **station_connection_args,
+            )
+        if batch_stations:
+            return self.all_connections(
+                stations={
+                    station_name: stations[station_name]
+                    for station_name in station_names
+                },
+                location_overrides=location_overrides,
+                **station_connection_args,
+            )
+        station_connections = [empty_connections_df()]
+        for station_name in station_names:
+            station_connections.append(self.connections(
+                station_name=station_name,
+                corridor_route_ids=stations[station_name],
+                location_overrides=location_overrides.get(station_name, []),
+                **station_connection_args,
+            ))
+        return pd.concat(station_connections, ignore_index=True)
+
+
+def get_station_connection_args(input_dict):
+    """Returns the connections arguments set in config.json"""
+    return dict(
+        connection_max_distance=input_dict['connection_max_distance'],
+        min_inbound_minutes=input_dict['min_inbound_minutes'],
+        max_inbound_minutes=input_dict['max_inbound_minutes'],
+        min_outbound_minutes=input_dict['min_outbound_minutes'],
+        max_outbound_minutes=input_dict['max_outbound_minutes'],
+        only_show_corridors=input_dict['only_show_corridors'],
+        hourly_summary=input_dict['hourly_summary'],
+        union_station_is_inbound=input_dict.get('union_station_is_inbound', False),
+        transfer_rules=read_transfer_rules(input_dict['input_path']),
+        write_raw_csv=input_dict.get('write_raw_csv', False),
+    )
+
+
+def get_date_connection_args(input_dict, station_connection_args, date_str):
+    """Adds the export of the date's classified nearby stop times to the connections
+    arguments if export_parquet_stop_times is set"""
+    if not input_dict.get('export_parquet_stop_times', False):
+        return station_connection_args
+    from connections_export import clear_date, get_date_path
+    clear_date('stop_times', date_str)
+    return dict(station_connection_args, raw_parquet_path=get_date_path('stop_times', date_str))
+
+
+def export_date_connections(input_dict, connections_df, date_str):
+    """Exports the date's connections to Parquet if export_parquet is set"""
+    if input_dict.get('export_parquet', False):
+        from connections_export import export_connections
+        export_connections(connections_df, date_str)
+
+
+DISTANCE_MODES = ['straight', 'walking']
+
+
+def read_station_distances(input_dict, stations, location_overrides):
+    """Returns the walking distances of the stations if distance_mode is walking, computing
+    them from the walking_network_path unless cached, None for straight-line distances"""
+    distance_mode = input_dict.get('distance_mode', 'straight')
+    if distance_mode not in DISTANCE_MODES:
+        raise ValueError('distance_mode must be one of {}'.format(', '.join(DISTANCE_MODES)))
+    if distance_mode == 'straight':
+        return None
+    from walking_distance import get_walking_distances
+    return get_walking_distances(input_dict, stations, location_overrides)
+
+
+def main():
+    """Writes the connections workbook(s) of the stations and dates in config.json"""
+    input_dict = read_config()
+    stations = read_stations(input_dict['input_path'])
+    location_overrides = read_location_overrides(input_dict['input_path'])
+    date_strs = read_config_dates(input_dict)
+    if input_dict.get('profile_stage'):
+        recorder.set_profiler(input_dict['profile_stage'], input_dict.get('profiler', 'cprofile'))
+    station_names = [station_name for station_name in stations if station_name != '']
+    network = Network.load(
+        date_strs=date_strs,
+        cache_path=input_dict.get('cache_path'),
+        workers=input_dict.get('feed_workers', 1),
+        missing_service=input_dict.get('missing_service', 'prompt'),
+        stream_stations=station_names if input_dict.get('stream_stop_times', False) else None,
+        location_overrides=location_overrides,
+        connection_max_distance=input_dict['connection_max_distance'],
+        directory=input_dict.get('gtfs_directory'),
+    )
+    station_distances = read_station_distances(input_dict, stations, location_overrides)
+    if station_distances is not None:
+        network.set_station_distances(station_distances)
+    network.anomalies_df.to_csv('./output/feed_anomalies.csv', index=False)
+    station_connection_args = get_station_connection_args(input_dict)
+    service_date_strs = network.service_dates()
+    if date_strs is None or len(date_strs) == 1:
+        network.select_service_date(service_date_strs[0])
+        connections_df = network.date_connections(
+            stations,
+            station_names,
+            location_overrides,
+            input_dict.get('batch_stations', True),
+            input_dict.get('station_workers', 1),
+            **get_date_connection_args(input_dict, station_connection_args, service_date_strs[0]),
+        )
+        # write the connections of each station as an excel sheet in a workbook having all stations
+        output_workbook(connections_df, station_names)
+        export_date_connections(input_dict, connections_df, service_date_strs[0])
+    else:
+        # the feeds are parsed once, each date only selects the stop times of its trips
+        date_connections = []
+        for date_str in date_strs:
+            if date_str not in service_date_strs:
+                print('No service found on', date_str)
+                continue
+            network.select_service_date(date_str)
+            connections_df = network.date_connections(
+                stations,
+                station_names,
+                location_overrides,
+                input_dict.get('batch_stations', True),
+                input_dict.get('station_workers', 1),
+                **get_date_connection_args(input_dict, station_connection_args, date_str),
+            )
+            output_workbook(
+                connections_df,
+                station_names,
+                './output/transit_connections_{date}.xlsx'.format(date=date_str),
+            )
+            export_date_connections(input_dict, connections_df, date_str)
+            date_connections.append(connections_df.assign(date=date_str))
+        output_summary_workbook(get_connections_summary(
+            pd.concat(date_connections, ignore_index=True),
+            station_names,
+            [date_str for date_str in date_strs if date_str in service_date_strs],
+        ))
+    # wall time, rows and peak memory of each stage, and the profile of profile_stage
+    print(recorder.write_report('./output/run_report'))
+
+
+# the guard keeps process pool workers from re-running the script when they import it
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from clocktime import seconds_to_clocktimes
+
+
+# Compact (CSR-style) storage of the stop sequence of every trip: the stops of the trip
+# with key i are stop_keys[offsets[i]:offsets[i+1]], with the matching departure times
+# in seconds. Replaces one Python tuple of stop_ids and one of hh:mm strings per trip.
+
+
+class TripStopSequences:
+
+    def __init__(self, offsets, stop_keys, departure_seconds, stop_ids):
+        self.offsets = offsets
+        self.stop_keys = stop_keys
+        self.departure_seconds = departure_seconds
+        # stop_id of every stop key, for the stop lists given to catviz
+        self.stop_ids = stop_ids
+
+    @classmethod
+    def from_stop_times(cls, trip_keys, stop_keys, departure_times, trip_count, stop_ids):
+        """Builds the sequences from stop time columns, keeping each trip's stop times in
+        the order they are given"""
+        trip_keys = np.asarray(trip_keys)
+        order = np.argsort(trip_keys, kind='stable')
+        offsets = np.zeros(trip_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(trip_keys, minlength=trip_count), out=offsets[1:])
+        departure_seconds = np.nan_to_num(
+            np.asarray(departure_times, dtype=float),
+            nan=-1,
+        ).astype(np.int32)
+        return cls(
+            offsets,
+            np.asarray(stop_keys, dtype=np.int32)[order],
+            departure_seconds[order],
+            np.asarray(stop_ids, dtype=object),
+        )
+
+    def stop_counts(self):
+        """Number of stops of every trip, by trip key"""
+        return np.diff(self.offsets)
+
+    def trip_stops(self, trip_key):
+        start, end = self.offsets[trip_key], self.offsets[trip_key + 1]
+        return tuple(self.stop_ids[self.stop_keys[start:end]])
+
+    def trip_stop_departure_times(self, trip_key):
+        start, end = self.offsets[trip_key], self.offsets[trip_key + 1]
+        return tuple(seconds_to_clocktimes(self.departure_seconds[start:end]))
+
+    def to_frames(self):
+        """Returns the sequences as dataframes, for the feed cache"""
+        return {
+            'trip_sequence_offsets': pd.DataFrame({'offset': self.offsets}),
+            'trip_sequence_stops': pd.DataFrame({
+                'stop_key': self.stop_keys,
+                'departure_seconds': self.departure_seconds,
+            }),
+        }
+
+    @classmethod
+    def from_frames(cls, frames, stop_ids):
+        return cls(
+            frames['trip_sequence_offsets']['offset'].to_numpy(dtype=np.int64),
+            frames['trip_sequence_stops']['stop_key'].to_numpy(dtype=np.int32),
+            frames['trip_sequence_stops']['departure_seconds'].to_numpy(dtype=np.int32),
+            np.asarray(stop_ids, dtype=object),
+        )
@@ -0,0 +1,370 @@
+import hashlib
+import heapq
+import json
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+
+import trip_connections
+from feed_keys import encode_keys
+from instrumentation import recorder
+from spatial_index import StopIndex, haversine
+
+
+# Walking distances from each station to the stops around it, along a footpath network,
+# for use in place of the straight-line connection distance (distance_mode "walking").
+# Run python walking_distance.py to precompute them for the stations in config.json.
+#
+# The network is either an OpenStreetMap extract (.osm XML, its walkable highways are
+# used) or a CSV edge list of footpaths with from_lat, from_lon, to_lat, to_lon columns
+# and an optional length column in metres (the straight-line length if missing). The
+# station and its stops are joined to the network nodes within SNAP_DISTANCE of them.
+#
+# The distances are searched up to connection_max_distance from every location of each
+# station (every stop of the station in the GTFS zips, or its Locations.csv overrides),
+# and stored as a sparse station x stop matrix in the cache_path along with the radius
+# searched. The matrix is stored under a key of the stations and locations, and of the
+# path, size and modification time of the GTFS zips and the network file (hashing them
+# would take longer than loading the matrix). It's reused for any connection_max_distance
+# up to the radius searched, and computed again for a larger one. Stops are stored by
+# (agency, stop_id) so that the matrix holds for any service date loaded from the zips.
+
+# bump whenever the distances computed change
+WALKING_VERSION = 1
+# metres between a station or stop and the network nodes it is joined to. Stops within
+# SNAP_DISTANCE of the station are reached directly.
+SNAP_DISTANCE = 100
+
+# highways that can't be walked along unless tagged with foot access
+NON_WALKING_HIGHWAYS = {
+    'motorway', 'motorway_link', 'construction', 'proposed', 'abandoned', 'raceway',
+    'bus_guideway',
+}
+FOOT_ACCESS = {'yes', 'designated', 'permissive'}
+NO_ACCESS = {'no', 'private'}
+
+
+def is_walkable(tags):
+    if 'highway' not in tags or tags.get('area') == 'yes':
+        return False
+    if tags.get('foot') in FOOT_ACCESS:
+        return True
+    if tags.get('foot') in NO_ACCESS or tags.get('access') in NO_ACCESS:
+        return False
+    return tags['highway'] not in NON_WALKING_HIGHWAYS
+
+
+def read_osm_edges(path):
+    """Returns (node_lats, node_lons, from_nodes, to_nodes) of the walkable ways of the
+    OSM extract. The nodes are read in a second pass so only the walkable ones are kept."""
+    way_refs = []
+    for _, element in ET.iterparse(path):
+        if element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            if is_walkable(tags):
+                way_refs.append([int(nd.get('ref')) for nd in element.iter('nd')])
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+    node_ids = {node_id: None for refs in way_refs for node_id in refs}
+    for _, element in ET.iterparse(path):
+        if element.tag == 'node':
+            node_id = int(element.get('id'))
+            if node_id in node_ids:
+                node_ids[node_id] = (float(element.get('lat')), float(element.get('lon')))
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+    # ways may reference nodes outside of the extract
+    located = [node_id for node_id, location in node_ids.items() if location is not None]
+    node_positions = {node_id: position for position, node_id in enumerate(located)}
+    from_nodes, to_nodes = [], []
+    for refs in way_refs:
+        for from_id, to_id in zip(refs[:-1], refs[1:]):
+            if from_id in node_positions and to_id in node_positions:
+                from_nodes.append(node_positions[from_id])
+                to_nodes.append(node_positions[to_id])
+    node_lats = np.array([node_ids[node_id][0] for node_id in located], dtype=float)
+    node_lons = np.array([node_ids[node_id][1] for node_id in located], dtype=float)
+    return node_lats, node_lons, np.array(from_nodes, dtype=np.int64), np.array(to_nodes, dtype=np.int64)
+
+
+def read_footpath_edges(path):
+    """Returns (node_lats, node_lons, from_nodes, to_nodes, lengths) of the edge list CSV,
+    lengths is None if the CSV has no length column"""
+    edges_df = pd.read_csv(path)
+    points = pd.concat([
+        edges_df[['from_lat', 'from_lon']].set_axis(['lat', 'lon'], axis=1),
+        edges_df[['to_lat', 'to_lon']].set_axis(['lat', 'lon'], axis=1),
+    ], ignore_index=True)
+    # the ends of the edges are the same node where their coordinates match
+    codes, nodes = pd.MultiIndex.from_frame(points.round(7)).factorize()
+    lengths = edges_df['length'].to_numpy(dtype=float) if 'length' in edges_df.columns else None
+    return (
+        nodes.get_level_values(0).to_numpy(dtype=float),
+        nodes.get_level_values(1).to_numpy(dtype=float),
+        codes[:len(edges_df)].astype(np.int64),
+        codes[len(edges_df):].astype(np.int64),
+        lengths,
+    )
+
+
+class WalkingGraph:
+    """Undirected footpath network, with the edges of each node stored contiguously"""
+
+    def __init__(self, node_lats, node_lons, from_nodes, to_nodes, lengths=None):
+        if lengths is None:
+            lengths = haversine(
+                node_lats[from_nodes],
+                node_lons[from_nodes],
+                node_lats[to_nodes],
+                node_lons[to_nodes],
+            )
+        from_nodes, to_nodes = np.concatenate([from_nodes, to_nodes]), np.concatenate([to_nodes, from_nodes])
+        lengths = np.concatenate([lengths, lengths])
+        order = np.argsort(from_nodes, kind='stable')
+        self.node_lats = node_lats
+        self.node_lons = node_lons
+        self.offsets = np.searchsorted(from_nodes[order], np.arange(len(node_lats) + 1)).tolist()
+        # lists are faster than arrays to index one element at a time
+        self.neighbours = to_nodes[order].tolist()
+        self.lengths = lengths[order].tolist()
+        self.node_index = StopIndex(node_lats, node_lons, cell_size=max(SNAP_DISTANCE, 100))
+
+    @classmethod
+    def read(cls, path):
+        """Reads an .osm extract, or a CSV edge list otherwise"""
+        if os.path.splitext(path)[1].lower() == '.osm':
+            return cls(*read_osm_edges(path))
+        return cls(*read_footpath_edges(path))
+
+    def snap(self, lats, lons):
+        """Returns dict of node -> distance of the nodes within SNAP_DISTANCE of the
+        closest of the given points"""
+        nodes, distances = self.node_index.within(lats, lons, SNAP_DISTANCE)
+        return dict(zip(nodes.tolist(), distances.tolist()))
+
+    def distances_from(self, sources, max_distance):
+        """Returns dict of node -> shortest distance from the closest source, of the nodes
+        within max_distance. sources is dict of node -> starting distance."""
+        distances = {}
+        heap = [(distance, node) for node, distance in sources.items()]
+        heapq.heapify(heap)
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if node in distances:
+                continue
+            distances[node] = distance
+            for position in range(self.offsets[node], self.offsets[node + 1]):
+                next_distance = distance + self.lengths[position]
+                neighbour = self.neighbours[position]
+                if next_distance <= max_distance and neighbour not in distances:
+                    heapq.heappush(heap, (next_distance, neighbour))
+        return distances
+
+
+class StationDistances:
+    """Sparse station x stop matrix of walking distances, the stops of the station at
+    row i are stop_ids[offsets[i]:offsets[i + 1]] (with their agencies)"""
+
+    def __init__(self, station_names, offsets, agencies, stop_ids, distances, max_distance, key=None):
+        self.station_names = list(station_names)
+        self.station_rows = {station_name: row for row, station_name in enumerate(self.station_names)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.agencies = np.asarray(agencies)
+        self.stop_ids = np.asarray(stop_ids)
+        self.distances = np.asarray(distances, dtype=float)
+        self.max_distance = max_distance
+        # walking_distances_key of the matrix
+        self.key = key
+        self.stop_keys = None
+
+    def set_stops(self, stops_df):
+        """Maps the stops to their stop keys in stops_df, -1 for the stops not loaded"""
+        self.stop_keys = encode_keys(
+            stops_df,
+            pd.DataFrame({'agency': self.agencies, 'stop_id': self.stop_ids}),
+            ['agency', 'stop_id'],
+        )
+
+    def nearby_stops(self, station_name, connection_max_distance):
+        """Returns (stop_keys, distances) of the loaded stops within connection_max_distance
+        of the station, or None if the station isn't in the matrix"""
+        if station_name not in self.station_rows:
+            return None
+        if connection_max_distance > self.max_distance:
+            raise ValueError('walking distances were computed up to {} metres, not {}'.format(
+                self.max_distance,
+                connection_max_distance,
+            ))
+        row = self.station_rows[station_name]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        stop_keys, distances = self.stop_keys[start:end], self.distances[start:end]
+        is_nearby = (stop_keys >= 0) & (distances <= connection_max_distance)
+        return stop_keys[is_nearby], distances[is_nearby]
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as matrix_file:
+            np.savez(
+                matrix_file,
+                station_names=np.array(self.station_names, dtype=str),
+                offsets=self.offsets,
+                agencies=self.agencies.astype(str),
+                stop_ids=self.stop_ids.astype(str),
+                distances=self.distances,
+                max_distance=np.array(self.max_distance, dtype=float),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, key=None):
+        with np.load(path) as matrix:
+            return cls(
+                matrix['station_names'],
+                matrix['offsets'],
+                matrix['agencies'],
+                matrix['stop_ids'],
+                matrix['distances'],
+                float(matrix['max_distance']),
+                key,
+            )
+
+
+def get_station_walking_distances(graph, stops_df, stops_index, station_name, station_stops, max_distance):
+    """Returns (positions, distances) of the stops of stops_df within max_distance walk of
+    any of the station stops, in order of position"""
+    sources = graph.snap(station_stops['stop_lat'], station_stops['stop_lon'])
+    node_distances = graph.distances_from(sources, max_distance)
+    # walking distances are never shorter than straight-line distances
+    candidates, straight_distances = stops_index.within(
+        station_stops['stop_lat'],
+        station_stops['stop_lon'],
+        max_distance,
+    )
+    positions, distances = [], []
+    for position, straight_distance in zip(candidates.tolist(), straight_distances.tolist()):
+        stop_nodes = graph.snap([stops_df['stop_lat'].iat[position]], [stops_df['stop_lon'].iat[position]])
+        distance = min(
+            [node_distances[node] + snap_distance for node, snap_distance in stop_nodes.items() if node in node_distances],
+            default=np.inf,
+        )
+        if straight_distance <= SNAP_DISTANCE:
+            distance = min(distance, straight_distance)
+        if distance <= max_distance:
+            positions.append(position)
+            distances.append(distance)
+    return np.array(positions, dtype=np.int64), np.array(distances, dtype=float)
+
+
+def compute_station_distances(graph, stops_df, station_names, location_overrides, max_distance):
+    """Returns the StationDistances of the stations to the stops of stops_df"""
+    stops_index = StopIndex(stops_df['stop_lat'], stops_df['stop_lon'])
+    offsets = [0]
+    station_positions, station_distances = [], []
+    for station_name in station_names:
+        with recorder.stage('get_walking_distances', station=station_name) as record:
+            station_stops = trip_connections.get_station_stops(
+                stops_df,
+                station_name,
+                location_overrides.get(station_name, []),
+            )
+            positions, distances = get_station_walking_distances(
+                graph,
+                stops_df,
+                stops_index,
+                station_name,
+                station_stops,
+                max_distance,
+            ) if len(station_stops) > 0 else (np.array([], dtype=np.int64), np.array([]))
+            station_positions.append(positions)
+            station_distances.append(distances)
+            offsets.append(offsets[-1] + len(positions))
+            record['rows_out'] = len(positions)
+    positions = np.concatenate(station_positions) if station_positions else np.array([], dtype=np.int64)
+    return StationDistances(
+        station_names,
+        offsets,
+        stops_df['agency'].to_numpy()[positions],
+        stops_df['stop_id'].to_numpy()[positions],
+        np.concatenate(station_distances) if station_distances else np.array([]),
+        max_distance,
+    )
+
+
+def get_file_state(path):
+    """Returns the path, size and modification time of the file"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def walking_distances_key(zip_paths, network_path, station_names, location_overrides):
+    key = {
+        'version': WALKING_VERSION,
+        'snap_distance': SNAP_DISTANCE,
+        'stations': sorted(station_names),
+        'location_overrides': {
+            station_name: location_overrides[station_name]
+            for station_name in sorted(station_names)
+            if station_name in location_overrides
+        },
+        'feeds': [get_file_state(path) for path in zip_paths],
+        'network': get_file_state(network_path),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_walking_station_names(stations, location_overrides):
+    """Returns the stations of Stations.csv, followed by the other stations of Locations.csv"""
+    station_names = [station_name for station_name in stations if station_name != '']
+    return station_names + [
+        station_name for station_name in location_overrides
+        if station_name != '' and station_name not in stations
+    ]
+
+
+def get_walking_distances(input_dict, stations, location_overrides):
+    """Returns the StationDistances of the stations in config.json, computing and caching
+    them unless the cache_path has them up to connection_max_distance or further"""
+    zip_paths = trip_connections.get_zip_paths(input_dict.get('gtfs_directory'))
+    network_path = input_dict['walking_network_path']
+    station_names = get_walking_station_names(stations, location_overrides)
+    max_distance = input_dict['connection_max_distance']
+    key = walking_distances_key(zip_paths, network_path, station_names, location_overrides)
+    cache_path = input_dict.get('cache_path') or 'cache'
+    path = os.path.join(cache_path, 'walking_{}.npz'.format(key))
+    if os.path.exists(path):
+        station_distances = StationDistances.load(path, key)
+        if max_distance <= station_distances.max_distance:
+            print('Loaded walking distances from cache', key)
+            return station_distances
+        print('Cached walking distances only go up to', station_distances.max_distance, 'metres')
+    with recorder.stage('read_walking_network'):
+        graph = WalkingGraph.read(network_path)
+    print('Read walking network of', len(graph.node_lats), 'nodes and', len(graph.neighbours) // 2, 'edges')
+    # the stops of every feed, regardless of the service dates loaded
+    stops_df = pd.concat(
+        [trip_connections.load_agency_stops(zip_path) for zip_path in zip_paths],
+        ignore_index=True,
+        join='inner',
+    )
+    station_distances = compute_station_distances(
+        graph,
+        stops_df,
+        station_names,
+        location_overrides,
+        max_distance,
+    )
+    station_distances.key = key
+    os.makedirs(cache_path, exist_ok=True)
+    station_distances.save(path)
+    print('Saved walking distances of', len(station_names), 'stations to', path)
+    return station_distances
+
+
+if __name__ == '__main__':
+    input_dict = trip_connections.read_config()
+    get_walking_distances(
+        input_dict,
+        trip_connections.read_stations(input_dict['input_path']),
+        trip_connections.read_location_overrides(input_dict['input_path']),
+    )